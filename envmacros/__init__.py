@@ -33,6 +33,9 @@ Example:
 		for step in result.steps:
 			print( step )
 
+	# To record every step, not just the errors:
+	resolver = envmacros.MacroResolver( trace = envmacros.MacroResult.TRACE_FULL )
+
 Also see the function:
 	import envmacros
 	
@@ -43,6 +46,33 @@ Also see the function:
 	envmacros.read_text_varfile( "somefilename.txt", my_lookup )
 """
 
+import importlib
 
 from .envmacros import *
 from .text_varfile import *
+from . import envmacros as _envmacros
+from . import text_varfile as _text_varfile
+
+# These are slow to import (or create), so they are
+# loaded when first used, see __getattr__()
+_lazy = { 'ExpressionEvaluator' : 'expressions',
+          'PythonEvalBackend'   : 'expressions',
+          'AstEvalBackend'      : 'expressions',
+          'VarfileReloader'     : 'varfile_reload',
+          'lookup'              : 'envmacros',
+          'resolver'            : 'envmacros',
+          'evaluator'           : 'envmacros' }
+
+# "from envmacros import *" loads them all
+__all__ = _envmacros.__all__ + _text_varfile.__all__ + list( _lazy )
+
+def __getattr__( name ):
+    module = _lazy.get( name )
+    if module == None:
+        raise AttributeError( "module %r has no attribute %r" % (__name__, name) )
+    value = getattr( importlib.import_module( '.' + module, __name__ ), name )
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted( list( globals() ) + list( _lazy ) )
@@ -0,0 +1,243 @@
+"""
+Microbenchmarks for envmacros.
+
+This generates synthetic workloads and reports, for each one, the
+operations per second, the p50/p99 latency and the peak memory of:
+
+    MacroResolver.resolve()    - wide, deep and long literal templates
+    ExpressionEvaluator.eval() - with both backends
+    read_text_varfile()        - generated varfiles, 20k and 100k lines
+    read_text_varfiles()       - several, one at a time and with
+                                 pools of threads and processes
+
+Results can be saved as a JSON baseline, and a later run compared
+against it, so regressions in the hot paths are caught.
+
+Usage:
+
+    python -m envmacros.bench [--quick] [--only NAME ...]
+                              [--save FILE] [--compare FILE] [--threshold 0.25]
+
+With --compare the exit code is 1 if any workload got slower than
+the baseline by more than the threshold (a fraction, 0.25 = 25%).
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+import envmacros
+
+__all__ = ['workloads', 'run', 'compare', 'main']
+
+BASELINE_VERSION = 1
+
+def _resolver( size ):
+    lookup = envmacros.MacroLookup( allow_env = False )
+    for x in range( size ):
+        lookup.add( 'v%d' % x, 'value%d' % x )
+    lookup.add( 'chain0', 'end' )
+    for x in range( 1, 41 ):
+        lookup.add( 'chain%d' % x, '<${chain%d}>' % (x - 1) )
+    lookup.add( 'one', '1' )
+    lookup.add( 'good_two', '(1+${one})' )
+    lookup.add( 'four', '(2*${good_two})' )
+    return envmacros.MacroResolver( lookup )
+
+def workloads( quick = False ):
+    """
+    Return a list of (name, setup), where setup() returns
+    (op, cleanup): op() is what is timed, cleanup() or None.
+    """
+    size = 200
+    lines = 20000
+    if quick:
+        size = 20
+        lines = 2000
+
+    def wide():
+        r = _resolver( size )
+        text = ' '.join( '${v%d}' % x for x in range( size ) )
+        return (lambda: r.resolve( text ), None)
+
+    def deep():
+        r = _resolver( size )
+        return (lambda: r.resolve( '${chain40}' ), None)
+
+    def literal():
+        r = _resolver( size )
+        text = ( 'x' * 1000 + '\n' ) * (size // 2) + '${v1} ${v2} ${v3}'
+        return (lambda: r.resolve( text ), None)
+
+    def expression( backend ):
+        def setup():
+            e = envmacros.ExpressionEvaluator( _resolver( 1 ), backend = backend )
+            text = '((0x0100 & (${one}<<(2*${four}))) != 0)'
+            return (lambda: e.eval( text ), None)
+        return setup
+
+    def varfile( n ):
+        def setup():
+            fd, fn = tempfile.mkstemp( suffix = '.txt' )
+            with os.fdopen( fd, 'w' ) as f:
+                for x in range( n ):
+                    f.write( 'var_%d = value ${var_%d} %d\n' % (x, x // 2, x) )
+            def op():
+                envmacros.read_text_varfile( fn, envmacros.MacroLookup( allow_env = False ) )
+            return (op, lambda: os.remove( fn ))
+        return setup
+
+    def varfiles( workers, processes ):
+        def setup():
+            d = tempfile.mkdtemp()
+            names = []
+            for n in range( 8 ):
+                fn = os.path.join( d, 'vars%d.txt' % n )
+                with open( fn, 'w' ) as f:
+                    for x in range( lines // 4 ):
+                        f.write( 'v%d_%d = value %d\n' % (n, x, x) )
+                names.append( fn )
+            def op():
+                envmacros.read_text_varfiles( names, envmacros.MacroLookup( allow_env = False ),
+                                              workers, processes = processes )
+            return (op, lambda: shutil.rmtree( d ))
+        return setup
+
+    return [ ('resolve_wide',    wide),
+             ('resolve_deep',    deep),
+             ('resolve_literal', literal),
+             ('eval_python',     expression( 'python' )),
+             ('eval_ast',        expression( 'ast' )),
+             ('varfile_load',    varfile( lines )),
+             ('varfile_big',     varfile( lines * 5 )),
+             ('varfiles_serial', varfiles( 1, False )),
+             ('varfiles_thread', varfiles( 4, False )),
+             ('varfiles_procs',  varfiles( 4, True )) ]
+
+def _percentile( times, fraction ):
+    # times must be sorted
+    return times[ min( len(times) - 1, int( len(times) * fraction ) ) ]
+
+def _measure( op, min_time, min_runs ):
+    """
+    Time op() until both min_time seconds and min_runs are reached.
+    """
+    times = []
+    clock = time.perf_counter
+    total = 0.0
+    while (total < min_time) or (len(times) < min_runs):
+        start = clock()
+        op()
+        t = clock() - start
+        times.append( t )
+        total += t
+    times.sort()
+    return {
+        'runs'        : len(times),
+        'ops_per_sec' : len(times) / total,
+        'p50_us'      : _percentile( times, 0.50 ) * 1e6,
+        'p99_us'      : _percentile( times, 0.99 ) * 1e6,
+    }
+
+def _peak_memory( op ):
+    """
+    Peak memory (in KiB) allocated by a single op()
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        op()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak / 1024.0
+
+def run( quick = False, only = None, min_time = None ):
+    """
+    Run the workloads, returning: name -> dict of measurements
+    """
+    if min_time == None:
+        min_time = 0.05 if quick else 0.5
+    results = dict()
+    for name, setup in workloads( quick ):
+        if only and (name not in only):
+            continue
+        op, cleanup = setup()
+        try:
+            # warm up the caches
+            op()
+            r = _measure( op, min_time, 5 )
+            r['peak_kib'] = _peak_memory( op )
+        finally:
+            if cleanup != None:
+                cleanup()
+        results[name] = r
+    return results
+
+def compare( baseline, results, threshold = 0.25 ):
+    """
+    Compare results against the baseline results, returning a list
+    of (name, baseline ops/sec, ops/sec) that are more than threshold
+    slower. Workloads missing from either are ignored.
+    """
+    slower = []
+    for name, r in results.items():
+        b = baseline.get( name )
+        if b == None:
+            continue
+        if r['ops_per_sec'] < b['ops_per_sec'] * (1.0 - threshold):
+            slower.append( (name, b['ops_per_sec'], r['ops_per_sec']) )
+    return slower
+
+def _report( results, out ):
+    out.write( "%-16s %12s %12s %12s %12s\n" % ('workload', 'ops/sec', 'p50 us', 'p99 us', 'peak KiB') )
+    for name, r in results.items():
+        out.write( "%-16s %12.1f %12.1f %12.1f %12.1f\n" %
+                   (name, r['ops_per_sec'], r['p50_us'], r['p99_us'], r['peak_kib']) )
+
+def main( argv = None ):
+    parser = argparse.ArgumentParser( prog = 'envmacros-bench',
+                                      description = 'envmacros microbenchmarks' )
+    parser.add_argument( '--quick', action = 'store_true',
+                         help = 'small workloads, short runs' )
+    parser.add_argument( '--only', nargs = '+', metavar = 'NAME',
+                         help = 'only run these workloads' )
+    parser.add_argument( '--save', metavar = 'FILE',
+                         help = 'save the results as a JSON baseline' )
+    parser.add_argument( '--compare', metavar = 'FILE',
+                         help = 'compare against a saved baseline' )
+    parser.add_argument( '--threshold', type = float, default = 0.25,
+                         help = 'allowed slow down when comparing (default: 0.25)' )
+    args = parser.parse_args( argv )
+
+    results = run( args.quick, args.only )
+    _report( results, sys.stdout )
+
+    if args.save:
+        with open( args.save, 'w' ) as f:
+            json.dump( { 'version' : BASELINE_VERSION,
+                         'python'  : sys.version.split()[0],
+                         'quick'   : args.quick,
+                         'results' : results }, f, indent = 2, sort_keys = True )
+
+    if args.compare:
+        with open( args.compare, 'r' ) as f:
+            baseline = json.load( f )
+        if baseline.get( 'version' ) != BASELINE_VERSION:
+            sys.stderr.write( "%s: unknown baseline version\n" % args.compare )
+            return 2
+        slower = compare( baseline['results'], results, args.threshold )
+        for name, was, now in slower:
+            sys.stdout.write( "REGRESSION: %s: %.1f -> %.1f ops/sec\n" % (name, was, now) )
+        if slower:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -2,33 +2,45 @@
 import re
 import os
 import time
-import math
 import sys
+import io
+import copy
+import types
+import collections
+import codecs
+import functools
+import threading
 from frozenclass import FrozenClass
 
-# We don't specifically use 'math'
-# but by importing this you can use
-# things like math.cos() and sin() in expressions.
-
-from math import *
+# asyncio and the expression evaluator (see expressions.py) are
+# slow to import, so they are imported when first used, and so are
+# the shared lookup, resolver and evaluator, see __getattr__()
 
 __all__ = ['MacroError',
            'MacroLookup',
            'MacroResolver',
            'MacroResult',
-           'ExpressionEvaluator',
-           'lookup',
-           'resolver',
-           'evaluator'
+           'CompiledTemplate',
+           'MacroStats',
+           'MacroProblem',
+           'dynamic_macro',
+           'register_function',
+           'unregister_function',
+           'DYNAMIC_VOLATILE',
+           'DYNAMIC_PER_RESOLVE',
+           'DYNAMIC_TTL'
 ]
 
 
-# this regex matches a C (or bash) style symbol, in the form: ${NAME}
-# the 3 matched named groups are 
-#    "before" - stuff before the invocation.
-#    "name" - the name of the macro
-#    "after" - the text after the macro
-_re_symbol = re.compile( "^(?P<before>.*)\$\{(?P<name>[A-Za-z_][0-9A-Za-z_]*)\}(?P<after>.*)$" )
+# The tokenizer only needs to find the two things that
+# delimit a macro invocation: the opening "${" and the closing "}"
+_re_token = re.compile( r'\$\{|\}' )
+
+# this regex matches a C (or bash) style symbol name, ie: the NAME in ${NAME}
+_re_name = re.compile( r'[A-Za-z_][0-9A-Za-z_]*$' )
+
+# this matches the start of a function call, ie: the "dirname(" in ${dirname(${X})}
+_re_call = re.compile( r'\s*([A-Za-z_][0-9A-Za-z_.]*)\s*\(' )
 
 DEBUG=False
 
@@ -40,37 +52,628 @@ if sys.version_info[0] == 2:
 else:
     _str_able_types = (int, float)
 
+# Where a macro was defined is kept as a small int:
+#     (file id << 32) | line number
+# and only made into a "filename:line" string when asked for.
+# File ids index _where_files, id 0 is not a file.
+_WHERE_LINE_BITS = 32
+_WHERE_LINE_MASK = (1 << _WHERE_LINE_BITS) - 1
+_where_files = [ None ]
+_where_ids = dict()
+_where_lock = threading.Lock()
+
+def _where_base( filename ):
+    """
+    Return the where of line 0 of filename, add the
+    line number to it for the where of a line.
+    """
+    base = _where_ids.get( filename )
+    if base == None:
+        with _where_lock:
+            base = _where_ids.get( filename )
+            if base == None:
+                base = len( _where_files ) << _WHERE_LINE_BITS
+                _where_files.append( filename )
+                _where_ids[filename] = base
+    return base
+
+def _where_text( where ):
+    """
+    Return where (a packed int, a string or None) as a string.
+    An int without a file id is a plain line number given by the
+    caller, it is returned as it is.
+    """
+    if (where.__class__ is int) and (where >> _WHERE_LINE_BITS):
+        return "%s:%d" % (_where_files[where >> _WHERE_LINE_BITS], where & _WHERE_LINE_MASK)
+    return where
+
+# How the value of a dynamic macro (ie: ${NOW}) is cached
+DYNAMIC_VOLATILE    = 'volatile'     # never, call it every time
+DYNAMIC_PER_RESOLVE = 'per-resolve'  # once per resolve() or batch
+DYNAMIC_TTL         = 'ttl'          # for ttl seconds
+_dynamic_policies = (DYNAMIC_VOLATILE, DYNAMIC_PER_RESOLVE, DYNAMIC_TTL)
+
+def dynamic_macro( policy = DYNAMIC_VOLATILE, ttl = None ):
+    """
+    Decorate a MacroLookup macro_NAME() method with its caching policy:
+
+        @envmacros.dynamic_macro( envmacros.DYNAMIC_TTL, ttl = 5.0 )
+        def macro_HOSTS( self, name, result ):
+            ...
+    """
+    assert( policy in _dynamic_policies )
+    assert( (policy != DYNAMIC_TTL) or (ttl != None) )
+    def decorate( func ):
+        func.dynamic_policy = (policy, ttl)
+        return func
+    return decorate
+
+class _Dynamic( object ):
+    """
+    An entry in the dynamic macro dispatch table.
+    """
+    __slots__ = ('func', 'fname', 'policy', 'ttl', 'where', 'is_async')
+    def __init__( self, func, fname, policy, ttl ):
+        self.func   = func
+        self.fname  = fname
+        self.policy = policy
+        self.ttl    = ttl
+        self.where  = "function: %s()" % fname
+        # async def, only usable with aresolve()
+        self.is_async = _is_async( func )
+
+# from inspect, which is slow to import
+_CO_COROUTINE = 0x80
+
+def _is_async( func ):
+    """
+    True if func (or the method func) is an "async def"
+    """
+    code = getattr( getattr( func, '__func__', func ), '__code__', None )
+    return (code != None) and bool( code.co_flags & _CO_COROUTINE )
+
+# class -> [ (name, method name, policy, ttl) ]
+_dynamic_tables = dict()
+
+def _class_dynamics( cls ):
+    """
+    Find the macro_NAME() methods of a MacroLookup class, once.
+    """
+    table = _dynamic_tables.get( cls )
+    if table == None:
+        table = []
+        for fname in dir( cls ):
+            if not fname.startswith( 'macro_' ):
+                continue
+            func = getattr( cls, fname )
+            if callable( func ):
+                policy, ttl = getattr( func, 'dynamic_policy', (DYNAMIC_VOLATILE, None) )
+                table.append( (fname[6:], fname, policy, ttl) )
+        _dynamic_tables[cls] = table
+    return table
+
+
+# A problem found by MacroLookup.validate()
+#    kind    - one of: 'cycle', 'undefined', 'malformed'
+#    name    - the macro with the problem
+#    where   - where that macro is defined, or None
+#    message - ie: "Undefined: FOO"
+MacroProblem = collections.namedtuple( 'MacroProblem', 'kind name where message' )
+
+_NO_CYCLES = frozenset()
 
 @FrozenClass
 class MacroLookup( object ):
     """
     This represents a basic macro lookup class
     that holds your macro variable names.
+
+    With cache=True the fully expanded value of each macro is
+    remembered, and forgotten again when something it depends
+    on is changed by add(). Values that come from os.environ
+    or dynamic macro_* functions are volatile and never cached.
+
+    validate() checks all the entries up front, and remembers
+    which macros are part of a cycle, see there.
+
+    child() creates a scope on top of this lookup, see there.
+    freeze() returns an immutable snapshot that can be shared
+    by resolvers in many threads without locks.
+
+    With allow_env, names not found fall back to os.environ,
+    how depends on env_mode:
+        ENV_LIVE     - read os.environ every time (the default)
+        ENV_SNAPSHOT - use a copy of os.environ
+        ENV_PREFIX   - use a copy of only the variables whose
+                       name starts with env_prefix
+    The copies are taken when created, and by refresh_env().
+
+    Names not found there can be dynamic: ${NOW} is handled by
+    the method macro_NOW(), or see register_dynamic(). Their values
+    are cached depending on the policy given with dynamic_macro().
+    These can be "async def", then they are only available with
+    MacroResolver.aresolve() and ExpressionEvaluator.aeval().
     """
-    def __init__(self, allow_env = True):
+    DYNAMIC_VOLATILE    = DYNAMIC_VOLATILE
+    DYNAMIC_PER_RESOLVE = DYNAMIC_PER_RESOLVE
+    DYNAMIC_TTL         = DYNAMIC_TTL
+    ENV_LIVE     = 'live'
+    ENV_SNAPSHOT = 'snapshot'
+    ENV_PREFIX   = 'prefix'
+    # deeper scopes remember what they found in their bases
+    SCOPE_CACHE_DEPTH = 2
+    def __init__(self, allow_env = True, cache = False, env_mode = None, env_prefix = None ):
         self.entries = dict()
         self.allow_env = allow_env
         self.parent    = None
+        # name -> (expanded value, expansion depth)
+        self.cache     = None
+        # name -> set of cached names that used it
+        self._rdeps    = dict()
+        if cache:
+            self.cache = dict()
+        # the lookup this is a scope of, see child()
+        self.base      = None
+        # the entries of all the bases, nearest first
+        self._layers   = ()
+        # changed when a lookup with children changes,
+        # shared by all the scopes of one root lookup
+        self._tree     = [0]
+        self._has_children = False
+        # name -> what _layers had, valid for version: _fall_version
+        self._fall     = None
+        self._fall_version = 0
+        # see freeze()
+        self.frozen    = False
+        if env_mode == None:
+            env_mode = self.ENV_LIVE
+        self.env_mode   = env_mode
+        self.env_prefix = env_prefix
+        # os.environ, or a copy of it
+        self._env      = None
+        if allow_env:
+            self.refresh_env()
+        # name -> _Dynamic
+        self._dynamic  = dict()
+        for n, fname, policy, ttl in _class_dynamics( self.__class__ ):
+            self._dynamic[n] = _Dynamic( getattr( self, fname ), fname, policy, ttl )
+        # name -> (expires, value) for DYNAMIC_TTL
+        self._dynamic_ttl = dict()
+        # (event loop, name) -> the task fetching an async dynamic macro
+        self._inflight = dict()
+        # a MacroStats() or None, see enable_stats()
+        self._stats    = None
+        # names known to be in a cycle, valid for version: _cyclic_version
+        self._cyclic   = _NO_CYCLES
+        self._cyclic_version = 0
+
+    def enable_stats( self, stats = None ):
+        """
+        Start counting lookups, see MacroStats.
+        Returns the MacroStats() that is used.
+        """
+        if stats == None:
+            stats = MacroStats()
+        self._stats = stats
+        return stats
+
+    def disable_stats( self ):
+        self._stats = None
+
+    def stats( self ):
+        """
+        Return a snapshot (a dict) of the statistics, or None
+        """
+        if self._stats == None:
+            return None
+        return self._stats.snapshot()
 
     def set_parent( self, parent ):
+        if self.frozen:
+            # shared, so it does not belong to one resolver
+            return
         self.parent = parent
 
+    def freeze( self, capture_env = False ):
+        """
+        Return an immutable snapshot of this lookup (and its bases).
+
+        The entries are flattened into one read only mapping and
+        add() raises MacroError, so resolvers and evaluators over
+        the snapshot need no locks and can be shared by threads.
+        With capture_env=True os.environ is copied now, and later
+        changes to the environment are not seen.
+        thaw() returns an editable lookup again.
+        """
+        flat = dict()
+        for layer in reversed( (self.entries,) + self._layers ):
+            flat.update( layer )
+        snap = copy.copy( self )
+        snap.entries = types.MappingProxyType( flat )
+        snap.parent = None
+        snap.cache = None
+        snap._rdeps = dict()
+        snap.base = None
+        snap._layers = ()
+        snap._tree = [0]
+        snap._cyclic_version = 0
+        snap._has_children = False
+        snap._fall = None
+        # not shared, register_dynamic() on self must not change snap
+        snap._dynamic = dict( self._dynamic )
+        snap._dynamic_ttl = dict( self._dynamic_ttl )
+        snap._inflight = dict()
+        snap.frozen = True
+        if capture_env:
+            if self._env == None:
+                snap._env = dict( os.environ )
+                snap.env_mode = self.ENV_SNAPSHOT
+            else:
+                snap._env = dict( self._env )
+        return snap
+
+    def register_dynamic( self, name, func, policy = DYNAMIC_VOLATILE, ttl = None ):
+        """
+        Make ${name} a dynamic macro, its value is func( name, result ).
+        The policy says how the value is cached, see dynamic_macro().
+        """
+        if self.frozen:
+            raise MacroError( "Frozen, cannot register: %s" % name )
+        assert( policy in _dynamic_policies )
+        assert( (policy != DYNAMIC_TTL) or (ttl != None) )
+        fname = getattr( func, '__name__', name )
+        self._dynamic[name] = _Dynamic( func, fname, policy, ttl )
+        self._dynamic_ttl.pop( name, None )
+
+    def _memo_ok( self, name ):
+        """
+        False if name is a DYNAMIC_VOLATILE macro,
+        whose value may not be remembered at all.
+        """
+        dyn = self._dynamic.get( name )
+        if (dyn == None) or (dyn.policy != DYNAMIC_VOLATILE):
+            return True
+        return (self._find( name ) != None) or self._in_env( name )
+
+    def _in_env( self, name ):
+        """
+        True if name would be found in the environment.
+        """
+        if not self.allow_env:
+            return False
+        env = self._env
+        if env == None:
+            env = os.environ
+        return name in env
+
+    def _env_value( self, name ):
+        """
+        The value of name in the environment, or None.
+        """
+        if not self.allow_env:
+            return None
+        env = self._env
+        if env == None:
+            env = os.environ
+        return env.get( name, None )
+
+    def refresh_env( self ):
+        """
+        Take a new copy of os.environ, see env_mode.
+        Scopes created with child() share the copy.
+        """
+        if self.frozen:
+            raise MacroError( "Frozen, cannot refresh_env()" )
+        mode = self.env_mode
+        if mode == self.ENV_LIVE:
+            self._env = None
+            return
+        if mode == self.ENV_SNAPSHOT:
+            env = dict( os.environ )
+        elif mode == self.ENV_PREFIX:
+            prefix = self.env_prefix
+            assert( isinstance( prefix, str ) )
+            env = dict( (n, v) for n, v in os.environ.items() if n.startswith( prefix ) )
+        else:
+            raise MacroError( "Unknown env_mode: %s" % mode )
+        if self._env == None:
+            self._env = env
+        else:
+            # update in place, so our scopes see it too
+            self._env.clear()
+            self._env.update( env )
+
+    def thaw( self ):
+        """
+        Return an editable lookup with the same entries, as a copy on
+        write scope on top of this one: changes go to the new lookup.
+        """
+        return self.child()
+
     def add( self, name, value, where = None ):
         """
         Add a name value pair.
-        With an optional location (ie: where defined)
+        With an optional location (ie: where defined), a string.
         """
         
+        if self.frozen:
+            raise MacroError( "Frozen, cannot add: %s" % name )
         if isinstance( value, _str_able_types ):
             value = str(value)
         assert( isinstance( value, str ) )
         self.entries[name] = (value, where)
+        self._cyclic = _NO_CYCLES
+        if self.cache != None:
+            self._invalidate( name )
+        if self._has_children:
+            self._tree[0] += 1
+
+    def update( self, entries ):
+        """
+        Add many entries at once, entries is a dict of:
+            name -> (value, where)
+        where each value is a string, see add() and where().
+        """
+        if self.frozen:
+            raise MacroError( "Frozen, cannot update" )
+        self.entries.update( entries )
+        self._cyclic = _NO_CYCLES
+        if self.cache != None:
+            for name in entries:
+                self._invalidate( name )
+        if self._has_children:
+            self._tree[0] += 1
+
+    def remove( self, name ):
+        """
+        Remove the entry name from this lookup (not its bases),
+        raises KeyError if it is not there.
+        """
+        if self.frozen:
+            raise MacroError( "Frozen, cannot remove: %s" % name )
+        del self.entries[name]
+        self._cyclic = _NO_CYCLES
+        if self.cache != None:
+            self._invalidate( name )
+        if self._has_children:
+            self._tree[0] += 1
+
+    def child( self ):
+        """
+        Return a new scope on top of this lookup, in O(1).
+
+        Reads fall through to this lookup (and its bases), while
+        add() only changes the child. So one large shared lookup
+        can have many cheap per request scopes with overrides.
+        Changes to this lookup are seen by the child. The child
+        starts without a value cache.
+        """
+        scope = copy.copy( self )
+        scope.entries = dict()
+        scope.cache = None
+        scope._rdeps = dict()
+        scope.base = self
+        scope._layers = (self.entries,) + self._layers
+        scope._has_children = False
+        scope._dynamic = dict( self._dynamic )
+        # not shared, see register_dynamic()
+        scope._dynamic_ttl = dict( self._dynamic_ttl )
+        scope._inflight = dict()
+        scope._cyclic = _NO_CYCLES
+        scope.frozen = False
+        scope._fall = None
+        if len( scope._layers ) >= self.SCOPE_CACHE_DEPTH:
+            scope._fall = dict()
+            scope._fall_version = self._tree[0]
+        if not self.frozen:
+            self._has_children = True
+        return scope
+
+    def _find( self, name ):
+        """
+        Return the (value, where) of name from this scope
+        or its bases, or None.
+        """
+        tuple_ = self.entries.get( name, None )
+        if (tuple_ != None) or (not self._layers):
+            return tuple_
+        fall = self._fall
+        if fall == None:
+            # a single base
+            return self._layers[0].get( name, None )
+        if self._fall_version != self._tree[0]:
+            # something changed in a base
+            fall.clear()
+            self._fall_version = self._tree[0]
+        try:
+            return fall[name]
+        except KeyError:
+            pass
+        for layer in self._layers:
+            tuple_ = layer.get( name, None )
+            if tuple_ != None:
+                break
+        fall[name] = tuple_
+        return tuple_
+
+    def _invalidate( self, name ):
+        """
+        Forget the cached values that depend on name.
+        """
+        todo = [ name ]
+        while todo:
+            name = todo.pop()
+            self.cache.pop( name, None )
+            users = self._rdeps.pop( name, None )
+            if users:
+                todo.extend( users )
+
+    def clear_cache( self ):
+        """
+        Forget all cached values.
+        """
+        if self.cache != None:
+            self.cache.clear()
+        self._rdeps.clear()
+
+    def validate( self ):
+        """
+        Check every entry (of this lookup and its bases) without
+        resolving anything, returning a list of MacroProblem() for:
+
+            cycle     - macros that refer to each other in a loop
+            undefined - a ${NAME} that is not an entry, in the
+                        environment or a dynamic macro
+            malformed - a "${" without its "}" or a bad name
+
+        The macros in a cycle are remembered until the next add(),
+        resolving them then fails at once with "Too many passes".
+        Names built from other macros, like ${parent_${child}},
+        cannot be checked until they are resolved.
+        """
+        flat = dict()
+        for layer in reversed( (self.entries,) + self._layers ):
+            flat.update( layer )
+
+        problems = []
+        graph = dict()
+        for name, (value, where) in flat.items():
+            refs = []
+            if '$' in value:
+                bad = _references( _parse( value ), refs )
+                if bad != None:
+                    problems.append( MacroProblem( 'malformed', name, _where_text( where ),
+                                                   "Malformed: %s" % bad ) )
+            edges = []
+            for ref in refs:
+                if ref in flat:
+                    edges.append( ref )
+                elif ref.endswith( '()' ):
+                    problems.append( MacroProblem( 'undefined', name, _where_text( where ),
+                                                   "Unknown function: %s" % ref ) )
+                elif not (self._in_env( ref ) or (ref in self._dynamic)):
+                    problems.append( MacroProblem( 'undefined', name, _where_text( where ),
+                                                   "Undefined: %s" % ref ) )
+            graph[name] = edges
+
+        cyclic = set()
+        for scc in _strongly_connected( graph ):
+            if (len(scc) == 1) and (scc[0] not in graph[scc[0]]):
+                continue
+            scc.sort()
+            cyclic.update( scc )
+            message = "Cycle: %s" % ', '.join( scc )
+            for name in scc:
+                problems.append( MacroProblem( 'cycle', name, _where_text( flat[name][1] ), message ) )
+        self._cyclic = frozenset( cyclic )
+        self._cyclic_version = self._tree[0]
+        return problems
+
+    def materialize( self, names = None, errors = None ):
+        """
+        Fully expand the macros names (default: all the entries,
+        of this lookup and its bases), returning a dict of:
+            name -> expanded value
+        ready for use as a subprocess environment.
+
+        Macros are expanded in dependency order, so each one that
+        others use is expanded only once. With cache=True the
+        values are kept, and calling materialize() again after
+        some add() only expands what those changes affected.
+
+        If errors is a dict, errors[name] = err_msg is set for each
+        macro that failed, and it is left out of the result. Otherwise
+        MacroError is raised for the first failure.
+        """
+        if names == None:
+            names = dict()
+            for layer in reversed( (self.entries,) + self._layers ):
+                names.update( layer )
+        wanted = set( names )
+        result = MacroResult( MacroResult.TRACE_OFF )
+        # so macros not cached (ie: ones that use ${NOW}) are
+        # still expanded once, and see the same ${NOW}
+        result.memo = dict()
+        out = dict()
+        done = set()
+        for root in names:
+            if root in done:
+                continue
+            # depth first, a macro is expanded after those it uses
+            path = set( [ root ] )
+            work = [ (root, iter( self._uses( root ) )) ]
+            while work:
+                name, refs = work[-1]
+                for ref in refs:
+                    if (ref not in done) and (ref not in path):
+                        path.add( ref )
+                        work.append( (ref, iter( self._uses( ref ) )) )
+                        break
+                else:
+                    work.pop()
+                    path.discard( name )
+                    done.add( name )
+                    if (name not in wanted) and (self._find( name ) == None):
+                        # not worth doing ahead of time
+                        continue
+                    result.reset()
+                    value = _expand( self, _MacroRef( name ), result, 0, None )
+                    if name not in wanted:
+                        continue
+                    if value != None:
+                        out[name] = value
+                    elif errors != None:
+                        errors[name] = result.err_msg
+                    else:
+                        raise MacroError( "%s: %s" % (name, result.err_msg) )
+        return out
+
+    def _uses( self, name ):
+        """
+        The names the value of entry name refers to,
+        none if its expanded value is cached.
+        """
+        tuple_ = self._find( name )
+        if (tuple_ == None) or ('$' not in tuple_[0]):
+            return ()
+        if (self.cache != None) and (name in self.cache):
+            return ()
+        refs = []
+        _references( _compile( tuple_[0] ).segments, refs )
+        return refs
+
+    def _is_cyclic( self, name ):
+        """
+        True if validate() found name in a cycle,
+        and nothing has changed since.
+        """
+        if self._cyclic_version != self._tree[0]:
+            # a base changed
+            self._cyclic = _NO_CYCLES
+            return False
+        return name in self._cyclic
+
+    def is_volatile( self, name ):
+        """
+        True if the value of name can change without add(),
+        ie: it comes from os.environ or a macro_* function.
+        """
+        return self._find( name ) == None
+
+    def where( self, name ):
+        """
+        Return where name was defined (ie: "filename:line") or None.
+        """
+        tuple_ = self._find( name )
+        if tuple_ == None:
+            return None
+        return _where_text( tuple_[1] )
 
     def list( self ):
         for n, v in self.entries.items():
             print("%s -> %s" % (n,v[0]) )
             if v[1]:
-                print("%s -> where: %s" % (n,v[1]) )
+                print("%s -> where: %s" % (n,_where_text( v[1] )) )
             
     def lookup( self, result, name ):
         """
@@ -79,90 +682,386 @@ class MacroLookup( object ):
 
         value = None
         where = None
-        result.where = None
+        result._where = None
         
-        # is it in our dictonary?
+        # is it in our dictonary (or one of our bases)?
         tuple_ = self.entries.get( name, None )
+        if (tuple_ == None) and self._layers:
+            tuple_ = self._find( name )
         if tuple_:
             value = tuple_[0]
             where = tuple_[1]
 
         # if not found
-        if (value == None) and self.allow_env:
-            value = os.environ.get( name, None )
+        if value == None:
+            value = self._env_value( name )
             if value != None:
                 where = "os.environ[%s]" % name
 
         # is it dynamic?
         if value == None:
-            fname =  'macro_' + name
-            func = getattr( self, fname, None)
-            if func != None:
-                where = "function: %s()" % fname
+            dyn = self._dynamic.get( name )
+            if dyn != None:
+                where = dyn.where
                 try:
-                    value = func( name, result )
+                    value = self._dynamic_value( dyn, name, result )
                 except Exception as e:
-                    result.err_msg = "Exception: %s() -> %s" % (fname, str(e))
+                    result.err_msg = "Exception: %s() -> %s" % (dyn.fname, str(e))
+                    result.add_error( result.err_msg )
                     return None
 
         if value == None:
             result.err_msg = "Undefined: %s" % name
+            result.add_error( result.err_msg )
             return None
         
-        result.where = where
-        if where != None:
-            result.add_step("%s: %s -> %s" % (where, name, value))
-        else:
-            result.add_step("%s -> %s" % (name,value))
+        result._where = where
+        if result.trace == _TRACE_FULL:
+            if where != None:
+                result.add_step("%s: %s -> %s", _where_text( where ), name, value)
+            else:
+                result.add_step("%s -> %s", name, value)
+        return value
+
+    def _dynamic_value( self, dyn, name, result ):
+        """
+        Call (or not) the function of a dynamic macro.
+        """
+        policy = dyn.policy
+        if dyn.is_async:
+            return self._awaited_value( dyn, name, result )
+        if policy == DYNAMIC_PER_RESOLVE:
+            values = result.dynamic
+            if values == None:
+                values = result.dynamic = dict()
+            elif name in values:
+                return values[name]
+            value = values[name] = dyn.func( name, result )
+            return value
+        if policy == DYNAMIC_TTL:
+            now = time.monotonic()
+            hit = self._dynamic_ttl.get( name )
+            if (hit != None) and (hit[0] > now):
+                return hit[1]
+            value = dyn.func( name, result )
+            if value != None:
+                self._dynamic_ttl[name] = (now + dyn.ttl, value)
+            return value
+        return dyn.func( name, result )
+
+    def _awaited_value( self, dyn, name, result ):
+        """
+        The value of an async dynamic macro, if aresolve() fetched it.
+        Otherwise the name is added to result.pending for aresolve()
+        to fetch, and "" is used until then.
+        """
+        if dyn.policy == DYNAMIC_TTL:
+            hit = self._dynamic_ttl.get( name )
+            if (hit != None) and (hit[0] > time.monotonic()):
+                return hit[1]
+        awaited = result.awaited
+        if awaited == None:
+            raise MacroError( "async, use aresolve() or aeval()" )
+        try:
+            return awaited[name]
+        except KeyError:
+            pass
+        result.pending.add( name )
+        return ''
+
+    async def _fetch( self, name, result ):
+        """
+        Await the value of the async dynamic macro name.
+        While a fetch of name is in flight, other callers in
+        the same event loop wait for the same fetch instead of
+        starting their own.
+        """
+        import asyncio
+        # a task belongs to its loop, and threads sharing a
+        # snapshot can each run a loop of their own
+        key = (asyncio.get_running_loop(), name)
+        task = self._inflight.get( key )
+        if task == None:
+            task = asyncio.ensure_future( self._call_async( self._dynamic[name], name, result ) )
+            self._inflight[key] = task
+            task.add_done_callback( lambda t: self._inflight.pop( key, None ) )
+        # one caller giving up does not cancel it for the others
+        return await asyncio.shield( task )
+
+    async def _call_async( self, dyn, name, result ):
+        value = dyn.func( name, result )
+        if hasattr( value, '__await__' ):
+            value = await value
+        if isinstance( value, _str_able_types ):
+            value = str( value )
+        if (value != None) and (dyn.policy == DYNAMIC_TTL):
+            self._dynamic_ttl[name] = (time.monotonic() + dyn.ttl, value)
         return value
 
+    @dynamic_macro( DYNAMIC_PER_RESOLVE )
     def macro_NOW(self, name, result):
         """
         This handles the macro ${NOW}
         """
         return time.ctime()
 
+    @dynamic_macro( DYNAMIC_PER_RESOLVE )
     def macro_GETCWD(self, name, result):
         """
         This handles the macro ${GETCWD}
         """
         return os.getcwd()
 
-# our global "macros"
-lookup = MacroLookup()
-    
-@FrozenClass
+# our global "macros", made on first use
+_shared = dict()
+_shared_lock = threading.RLock()
+
+def _default( name ):
+    """
+    Return the shared 'lookup', 'resolver' or 'evaluator'
+    """
+    value = _shared.get( name )
+    if value != None:
+        return value
+    with _shared_lock:
+        value = _shared.get( name )
+        if value == None:
+            if name == 'lookup':
+                value = MacroLookup()
+            elif name == 'resolver':
+                value = MacroResolver( _default( 'lookup' ) )
+            else:
+                from .expressions import ExpressionEvaluator
+                value = ExpressionEvaluator( _default( 'resolver' ) )
+            _shared[name] = value
+    return value
+
 class MacroResult(object):
     """
     A macro resolution result.
     The resulting transformation is found in self.result.
     
     If self.result is None, then see self.err_msg.
-    Additional debug information can be found in self.steps
+    Additional debug information can be found in self.steps,
+    how much is recorded depends on the trace level:
+
+        TRACE_OFF    - nothing
+        TRACE_ERRORS - only steps that explain an error (default)
+        TRACE_FULL   - every step of the resolution
+
+    Steps are kept as (format, args) and only formatted when read.
+
+    To avoid making a new result for every resolve, pass the same
+    result each time, ie: resolver.resolve( text, result.reset() )
     """
+    __slots__ = ('pass_count', 'pass_max', 'err_msg', 'result', '_where',
+                 'trace', '_steps', 'memo', 'dynamic', 'pending', 'awaited')
     PASS_MAX = 50
-    def __init__(self):
+    TRACE_OFF    = 0
+    TRACE_ERRORS = 1
+    TRACE_FULL   = 2
+    TRACE = TRACE_ERRORS
+    def __init__(self, trace = None):
         self.pass_count = 0
         self.pass_max   = self.PASS_MAX
         self.err_msg = None
         self.result = None
-        self.steps = []
-        self.where = None
+        self._where = None
+        if trace == None:
+            trace = self.TRACE
+        self.trace = trace
+        self._steps = None
+        # name -> (value, depth, volatile) of macros already expanded,
+        # None unless this result is shared by a batch, see resolve_many()
+        self.memo = None
+        # name -> value of DYNAMIC_PER_RESOLVE macros
+        self.dynamic = None
+        # async macros to fetch, and name -> value of those fetched,
+        # only set during MacroResolver.aresolve()
+        self.pending = None
+        self.awaited = None
+
+    def reset( self ):
+        """
+        Forget the previous resolution so this result can be reused.
+        Returns self.
+        """
+        self.pass_count = 0
+        self.err_msg = None
+        self.result = None
+        self._where = None
+        self._steps = None
+        self.dynamic = None
+        self.pending = None
+        self.awaited = None
+        return self
+
+    @property
+    def where( self ):
+        """
+        Where the last macro looked up was defined, or None.
+        """
+        return _where_text( self._where )
+
+    @where.setter
+    def where( self, where ):
+        self._where = where
+
+    @property
+    def steps( self ):
+        """
+        The recorded steps, as a list of strings.
+        """
+        if not self._steps:
+            return []
+        return [ (fmt % args) if args else fmt for fmt, args in self._steps ]
+
+    def add_step( self, fmt, *args ):
+        """
+        Record a step, only kept with TRACE_FULL.
+        Formatting is deferred: add_step( "%s -> %s", name, value )
+        """
+        if self.trace >= _TRACE_FULL:
+            self._add( fmt, args )
+
+    def add_error( self, fmt, *args ):
+        """
+        Record a step that explains an error, kept unless TRACE_OFF.
+        """
+        if self.trace >= _TRACE_ERRORS:
+            self._add( fmt, args )
+
+    def _add( self, fmt, args ):
+        if self._steps == None:
+            self._steps = []
+        self._steps.append( (fmt, args) )
+
+_TRACE_ERRORS = MacroResult.TRACE_ERRORS
+_TRACE_FULL   = MacroResult.TRACE_FULL
+
+_clock = time.perf_counter
+
+@FrozenClass
+class MacroStats(object):
+    """
+    Counters and timers for the macros of a MacroLookup,
+    enabled with MacroResolver.enable_stats(). When disabled
+    the cost is a single attribute check.
+
+        lookups  - name -> how often it was looked up
+        sources  - where values came from -> count, one of:
+                   entries, env, dynamic, undefined, cached, memo
+        depths   - expansion depth (MacroResult.pass_count) -> resolves
+        time_lookup, time_substitute, time_eval - total seconds
+
+    callbacks are called as callback( name, source, seconds ) for
+    every lookup, and the sampler as sampler( result ) for every
+    sample_every-th resolve. The counters are not locked, so
+    with many threads they are approximate.
+    """
+    SOURCES = ('entries', 'env', 'dynamic', 'undefined', 'cached', 'memo')
+    def __init__( self, sampler = None, sample_every = 100 ):
+        self.lookups = collections.Counter()
+        self.sources = dict( (source, 0) for source in self.SOURCES )
+        self.depths  = collections.Counter()
+        self.resolves = 0
+        self.evals    = 0
+        self.time_lookup     = 0.0
+        self.time_substitute = 0.0
+        self.time_eval       = 0.0
+        self.callbacks = []
+        self.sampler = sampler
+        self.sample_every = sample_every
+
+    def add_callback( self, callback ):
+        self.callbacks.append( callback )
+
+    def hit( self, name, source ):
+        """
+        Count a value found in a cache or memo.
+        """
+        self.lookups[name] += 1
+        self.sources[source] += 1
+        for callback in self.callbacks:
+            callback( name, source, 0.0 )
+
+    def timed_lookup( self, lookup, result, name ):
+        """
+        Count and time lookup.lookup( result, name )
+        """
+        start = _clock()
+        value = lookup.lookup( result, name )
+        seconds = _clock() - start
+        self.time_lookup += seconds
+        if value == None:
+            source = 'undefined'
+        elif lookup._find( name ) != None:
+            source = 'entries'
+        elif lookup._in_env( name ):
+            source = 'env'
+        else:
+            source = 'dynamic'
+        self.lookups[name] += 1
+        self.sources[source] += 1
+        for callback in self.callbacks:
+            callback( name, source, seconds )
+        return value
+
+    def timed_render( self, template, lookup, result ):
+        """
+        Count and time template.render( lookup, result )
+        """
+        start = _clock()
+        before = self.time_lookup
+        template._render_into( lookup, result )
+        seconds = _clock() - start
+        self.time_substitute += seconds - (self.time_lookup - before)
+        self.resolves += 1
+        self.depths[result.pass_count] += 1
+        if (self.sampler != None) and (self.resolves % self.sample_every == 0):
+            self.sampler( result )
+        return result
 
-    def add_step( self, txt ):
-        self.steps.append( txt )
+    def timed_evaluate( self, backend, text ):
+        """
+        Count and time backend.evaluate( text )
+        """
+        start = _clock()
+        try:
+            return backend.evaluate( text )
+        finally:
+            self.time_eval += _clock() - start
+            self.evals += 1
+
+    def snapshot( self ):
+        """
+        Return a copy of the statistics as a dict.
+        """
+        return {
+            'lookups'         : dict( self.lookups ),
+            'sources'         : dict( self.sources ),
+            'depths'          : dict( self.depths ),
+            'resolves'        : self.resolves,
+            'evals'           : self.evals,
+            'time_lookup'     : self.time_lookup,
+            'time_substitute' : self.time_substitute,
+            'time_eval'       : self.time_eval,
+        }
 
 @FrozenClass
 class MacroResolver(object):
     """
     Evaluate a string, replacing all ${macros} with their values.
     Returns a MacroResult()
+
+    The trace level (see MacroResult) applies to results
+    created by resolve(), the default is MacroResult.TRACE
     """
-    def __init__(self, my_lookup = None ):
+    def __init__(self, my_lookup = None, trace = None ):
         self.result = None
+        self.trace  = trace
         if my_lookup == None:
-            global lookup
-            my_lookup = lookup
+            my_lookup = _default( 'lookup' )
         assert( isinstance( my_lookup, MacroLookup ) )
         self.lookup = my_lookup
         self.lookup.set_parent( self )
@@ -170,226 +1069,814 @@ class MacroResolver(object):
     def resolve( self, text, result=None ):
         """
         Given text, resolve all macros.
+        A result can be passed in to be reused, see MacroResult.
         """
         if result == None:
-            result = MacroResult()
-        result.add_step("start: %s" % text )
-        result.err_msg = None
-        result.result  = text
+            result = MacroResult( self.trace )
+        return self.compile( text ).render( self.lookup, result )
 
-        # ALL macros have $ signs.
-        if '$' not in result.result:
-            # if no $ signs occur.. we are done
-            return result
-        
-        while self._make_pass(result):
-            result.pass_count += 1
-            if result.pass_count > result.pass_max:
-                result.add_step("too many passes")
-                result.err_msg = "Too many passes"
-                break
-            result.add_step("pass: %d -> %s" % (result.pass_count, result.result))
-        # if an error occurred
-        if result.err_msg != None:
-            # do not return text.
-            result.result = None
+    async def aresolve( self, text, result = None ):
+        """
+        Like resolve(), for use with async dynamic macros.
+
+        The text is resolved, noting which async macros it needs,
+        those are fetched at the same time with asyncio.gather(),
+        and the text is resolved again, until nothing is missing.
+        """
+        import asyncio
+        if result == None:
+            result = MacroResult( self.trace )
+        template = self.compile( text )
+        lookup = self.lookup
+        steps = result._steps
+        result.awaited = dict()
+        result.pending = set()
+        try:
+            while True:
+                # forget the steps of a try that was missing values
+                if steps:
+                    result._steps = list( steps )
+                else:
+                    result._steps = None
+                template.render( lookup, result )
+                if not result.pending:
+                    break
+                names = list( result.pending )
+                result.pending.clear()
+                values = await asyncio.gather( *[ lookup._fetch( n, result ) for n in names ],
+                                               return_exceptions = True )
+                for name, value in zip( names, values ):
+                    if isinstance( value, Exception ):
+                        result.result = None
+                        result.err_msg = "Exception: %s() -> %s" % (lookup._dynamic[name].fname, value)
+                        result.add_error( result.err_msg )
+                        return result
+                    if isinstance( value, BaseException ):
+                        raise value
+                    result.awaited[name] = value
+        finally:
+            result.awaited = None
+            result.pending = None
         return result
 
-    def _make_pass(self, result):
-        # FUTURE: support function like macros
-        # for example:  ${str.upper(${foo})}
-        
-        # Make a single pass over the string resolving macros.
-        m = _re_symbol.match( result.result )
-        if m is None:
-            # no macro invocation found
-            return False
+    def resolve_many( self, texts, errors = None ):
+        """
+        Resolve each text from the iterable texts, yielding the
+        resulting text, or None if there was an error.
 
-        mname = m.group('name')
-        if DEBUG:
-            result.add_step("text-before='%s'" % m.group('before'))
-            result.add_step("macro: %s" % mname )
-            result.add_step("text-after='%s'" % m.group('after'))
-        
-        txt = self.lookup.lookup( result, mname )
-        if txt == None:
-            return False
-        result.result = m.group('before') + txt + m.group('after')
-        result.add_step("New: %s" % result.result )
-        return True
-
-resolver = MacroResolver(lookup)
-
-# match hex numbers
-_re_hex = re.compile('0[xX][0-9a-fA-F]+')
-
-# what strings are ok in our restricted number only modemode?
-_ok_whitelist = set()
-_ok_whitelist.add('True')
-_ok_whitelist.add('False')
-_ok_whitelist.add('and')
-_ok_whitelist.add('or')
-_ok_whitelist.add('not')
-# All functions in math
-for tmp in dir(math):
-    if tmp[0] != '_':
-        tmp = tmp + '('
-        _ok_whitelist.add(tmp)
-
-# digits or numbers
-_re_digits  = re.compile(  r'^[0123456789.]+$')
-
-# these are chars we can ignore
-# or safely transform to spaces
-_str_from = "-+*/&|%!~<>=.)"
-_str_to   = "              "
-
-try:
-    # Python > 3.1
-    _table_to_space = str.maketrans( _str_from, _str_to )
-except:
-    # Python < 3.1
-    import string
-    _table_to_space = string.maketrans( _str_from, _str_to )
-
-def _safe_eval_check( text ):
-    ''' 
-    Returns None if the string is ok to eval.
-
-    Returns an error message if the string is not safe to eval.
-
-    The technique is generally replace safe things with spaces
-    Then split the string on spaces and deal with each possbile
-    thing we might find - we are not checking syntax here.
-    We let python handle the syntax.
-    '''
-    
-    # Python allows spaces between the function
-    # and the opening parens we need to fix that.
-    # for example:  "cos   (123)" we must
-    # convert this into "cos(123)"
+        If errors is a dict, errors[index] = err_msg is set
+        for each text that failed.
 
-    oldlen = len(text)
-    while True:
-        # replace what we can
-        text = text.replace( ' (', '(' )
-        # If any change occurs, our string is shorter
-        newlen = len(text)
-        if oldlen == newlen:
-            # no change, we are done
-            break
-        # Try again
-        oldlen = newlen
-
-
-    # Now, we might have a string like this:
-    # For example:   "cos(123)*(4 >= ~123) && False < 7"
-    #
-    # What matters to us is is the "cos(" part that could
-    # instead be some evilfunction() call.
-
-    # We need to seperate cos(123) into: "cos( 123 )"
-    # by adding spaces we can use str.split() to parse.
-    #
-    text = text.replace( '(', '( ')
-
-    # our string is now something like this:
-    # And we can throw away all of our math operators.
-    #
-    # old: "cos(123)*(4 >= ~123) && False < 7"
-    # new: "cos( 123   4     123     False   7"
-    text = text.translate( _table_to_space )
-
-    # we have a white list of function names.
-    # we can check each part of the new string
-    # against our white list of function names.
-    for part in text.split( ' ' ):
-
-        # ignore blanks
-        if len(part)==0:
-            continue
+        Each macro is looked up once for the whole batch,
+        so dynamic macros like ${NOW} keep their first value.
+        """
+        result = MacroResult( self.trace )
+        result.memo = dict()
+        for index, text in enumerate( texts ):
+            result.reset()
+            self.resolve( text, result )
+            if (result.err_msg != None) and (errors != None):
+                errors[index] = result.err_msg
+            yield result.result
 
-        if part == '(':
-            # this happens in simple expressions
-            continue
-        
-        # Most common will be pure digits.
-        m = _re_digits.match( part )
-        if m != None:
+    def render_stream( self, infile, outfile, chunk_size = None, result = None, encoding = 'utf-8' ):
+        """
+        Resolve all macros in infile, writing the text to outfile.
+
+        The input is read chunk_size characters at a time, a ${...}
+        that crosses a chunk boundary is carried over to the next chunk.
+        infile can be a text stream, a binary stream or an mmap, binary
+        input and output use the given encoding.
+
+        Returns a MacroResult(), result.result is the number of characters
+        written. On error result.err_msg starts with the line and column
+        in infile and result.where is "filename:line:column".
+        """
+        if result == None:
+            result = MacroResult( self.trace )
+        if chunk_size == None:
+            chunk_size = STREAM_CHUNK_SIZE
+        # the memo is only for this stream, and forgotten after it
+        memo = result.memo
+        result.memo = dict()
+        try:
+            return self._render_stream( infile, outfile, chunk_size, result, encoding )
+        finally:
+            result.memo = memo
+
+    def _render_stream( self, infile, outfile, chunk_size, result, encoding ):
+        binary_out = isinstance( outfile, (io.RawIOBase, io.BufferedIOBase) )
+
+        written = 0
+        line = 1
+        column = 1
+        carry = ''
+        for chunk in _read_chunks( infile, chunk_size, encoding ):
+            text = carry + chunk
+            if chunk:
+                cut = _stream_cut( text )
+                if cut < len(text) - STREAM_CARRY_MAX:
+                    # too long to be a macro, treat the "${" as text
+                    cut = len(text)
+            else:
+                # the end, anything left over is text
+                cut = len(text)
+            piece = text[:cut]
+            carry = text[cut:]
+            if not piece:
+                continue
+
+            result.reset()
+            # not compiled with _compile(), the chunks would fill its cache
+            CompiledTemplate( piece, _parse( piece ) ).render( self.lookup, result )
+            if result.err_msg != None:
+                offset = _stream_locate( self, piece, result )
+                line, column = _advance( piece[:offset], line, column )
+                where = getattr( infile, 'name', None ) or '<stream>'
+                result.where = "%s:%d:%d" % (where, line, column)
+                result.err_msg = "line %d, column %d: %s" % (line, column, result.err_msg)
+                result.result = None
+                return result
+
+            if binary_out:
+                outfile.write( result.result.encode( encoding ) )
+            else:
+                outfile.write( result.result )
+            written += len( result.result )
+            line, column = _advance( piece, line, column )
+        result.result = written
+        return result
+
+    def enable_stats( self, stats = None ):
+        """
+        Start counting lookups, resolves and evaluations made with
+        our lookup, see MacroStats. Returns the MacroStats() used.
+        """
+        return self.lookup.enable_stats( stats )
+
+    def disable_stats( self ):
+        self.lookup.disable_stats()
+
+    def stats( self ):
+        """
+        Return a snapshot (a dict) of the statistics, or None
+        """
+        return self.lookup.stats()
+
+    def compile( self, text ):
+        """
+        Parse text once, returning a reusable CompiledTemplate.
+        Recently compiled templates are cached by their text.
+        """
+        return _compile( text )
+
+class _MacroRef( object ):
+    """
+    A parsed ${...} reference.
+    Simple references have a 'name', references like
+    ${parent_${child}} instead have 'parts' which
+    must be resolved to find the name.
+    """
+    __slots__ = ('name', 'parts')
+    def __init__( self, name, parts = None ):
+        self.name  = name
+        self.parts = parts
+
+# Results of pure functions are cached per argument tuple.
+FUNCTION_CACHE_MAX = 1024
+
+class _Function( object ):
+    """
+    An entry in the function registry.
+    """
+    __slots__ = ('name', 'func', 'pure', 'lookup')
+    def __init__( self, name, func, pure, lookup = False ):
+        self.name = name
+        self.func = func
+        self.pure = pure
+        # func( lookup, arg, ... )
+        self.lookup = lookup
+
+# name -> _Function(), see register_function()
+_functions = dict()
+
+def register_function( name, func, pure = False, lookup = False ):
+    """
+    Make func callable from a macro as ${name(arg,...)}
+
+    The arguments are passed as strings, func must return
+    a string (or a number). If pure is True the result only
+    depends on the arguments, and results are cached.
+    If lookup is True it is called as func( lookup, arg, ... )
+    with the MacroLookup being resolved.
+    """
+    if not _re_call.match( name + '(' ):
+        raise MacroError("Invalid function name: %s" % name)
+    if pure and lookup:
+        raise MacroError("A function that uses the lookup is not pure: %s" % name)
+    if pure:
+        func = functools.lru_cache( maxsize = FUNCTION_CACHE_MAX )( func )
+    _functions[name] = _Function( name, func, pure, lookup )
+    # functions are bound when a template is parsed
+    _compile_cached.cache_clear()
+
+def unregister_function( name ):
+    """
+    Remove a function added by register_function()
+    """
+    del _functions[name]
+    _compile_cached.cache_clear()
+
+def _env_function( lookup, name, default = '' ):
+    # the same environment as ${name}, see allow_env and env_mode
+    value = lookup._env_value( name )
+    if value == None:
+        return default
+    return value
+
+for _name, _func, _pure in (
+        ('dirname',          os.path.dirname,  True),
+        ('basename',         os.path.basename, True),
+        ('join',             os.path.join,     True),
+        ('upper',            str.upper,        True),
+        ('lower',            str.lower,        True),
+        ('env',              _env_function,    False),
+        ('os.path.dirname',  os.path.dirname,  True),
+        ('os.path.basename', os.path.basename, True),
+        ('os.path.join',     os.path.join,     True),
+        ('str.upper',        str.upper,        True),
+        ('str.lower',        str.lower,        True) ):
+    if _pure:
+        _func = functools.lru_cache( maxsize = FUNCTION_CACHE_MAX )( _func )
+    _functions[_name] = _Function( _name, _func, _pure, _func is _env_function )
+
+class _MacroCall( object ):
+    """
+    A parsed ${name(arg,...)} function call, the function
+    is looked up when parsed. Each argument is a tuple of
+    segments, like a template.
+    """
+    __slots__ = ('name', 'function', 'args')
+    def __init__( self, name, function, args ):
+        self.name     = name
+        self.function = function
+        self.args     = args
+
+def _split_args( parts ):
+    """
+    Split the segments between "(" and ")" at the top level commas
+    in the literal text. Commas in the values of macros do not split.
+    """
+    args = []
+    arg = []
+    nested = 0
+    for p in parts:
+        if p.__class__ is not str:
+            arg.append( p )
             continue
+        start = 0
+        for x, c in enumerate( p ):
+            if c == '(':
+                nested += 1
+            elif c == ')':
+                nested -= 1
+            elif (c == ',') and (nested == 0):
+                arg.append( p[start:x] )
+                args.append( arg )
+                arg = []
+                start = x + 1
+        arg.append( p[start:] )
+    args.append( arg )
+    result = []
+    for arg in args:
+        if arg[0].__class__ is str:
+            arg[0] = arg[0].lstrip()
+        if arg[-1].__class__ is str:
+            arg[-1] = arg[-1].rstrip()
+        result.append( _merge( [ p for p in arg if p != '' ] ) )
+    if (len(result) == 1) and (result[0] == ()):
+        # no arguments, ie: ${name()}
+        return ()
+    return tuple( result )
+
+def _parse_call( parts ):
+    """
+    If parts look like: name(...) return a _MacroCall() otherwise None
+    """
+    first = parts[0]
+    last = parts[-1]
+    if (first.__class__ is not str) or (last.__class__ is not str):
+        return None
+    m = _re_call.match( first )
+    if (m == None) or not last.rstrip().endswith( ')' ):
+        return None
+    inner = list( parts )
+    if len(inner) == 1:
+        inner[0] = first[m.end():last.rindex( ')' )]
+    else:
+        inner[0] = first[m.end():]
+        inner[-1] = last[:last.rindex( ')' )]
+    name = m.group( 1 )
+    return _MacroCall( name, _functions.get( name ), _split_args( inner ) )
+
+def _references( segments, refs ):
+    """
+    Add the names the parsed segments refer to, to the list refs.
+    Function calls are added as "name()" if the function is unknown.
+    Returns the malformed text found, or None.
+    """
+    bad = None
+    for seg in segments:
+        cls = seg.__class__
+        if cls is str:
+            if ('${' in seg) and (bad == None):
+                bad = seg.strip()
+        elif cls is _MacroRef:
+            if seg.name != None:
+                refs.append( seg.name )
+            else:
+                bad = _references( seg.parts, refs ) or bad
+        else:
+            if seg.function == None:
+                refs.append( seg.name + '()' )
+            for arg in seg.args:
+                bad = _references( arg, refs ) or bad
+    return bad
 
-        # Allow hex digits
-        m = _re_hex.match( part )
-        if m != None:
+def _strongly_connected( graph ):
+    """
+    Tarjan's algorithm, without recursion. graph is: name -> [ names ]
+    Returns a list of the strongly connected components, each a list.
+    """
+    index = dict()
+    low = dict()
+    stack = []
+    on_stack = set()
+    found = []
+    for root in graph:
+        if root in index:
             continue
+        index[root] = low[root] = len( index )
+        stack.append( root )
+        on_stack.add( root )
+        work = [ (root, iter( graph[root] )) ]
+        while work:
+            node, edges = work[-1]
+            for next_ in edges:
+                if next_ not in index:
+                    index[next_] = low[next_] = len( index )
+                    stack.append( next_ )
+                    on_stack.add( next_ )
+                    work.append( (next_, iter( graph[next_] )) )
+                    break
+                if (next_ in on_stack) and (index[next_] < low[node]):
+                    low[node] = index[next_]
+            else:
+                # all edges of node are done
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if low[node] < low[parent]:
+                        low[parent] = low[node]
+                if low[node] == index[node]:
+                    scc = []
+                    while True:
+                        n = stack.pop()
+                        on_stack.discard( n )
+                        scc.append( n )
+                        if n == node:
+                            break
+                    found.append( scc )
+    return found
+
+def _merge( segments ):
+    """
+    Join adjacent literal strings, returning a tuple of segments.
+    """
+    merged = []
+    for seg in segments:
+        if merged and (seg.__class__ is str) and (merged[-1].__class__ is str):
+            merged[-1] = merged[-1] + seg
+        else:
+            merged.append( seg )
+    return tuple( merged )
 
-        # We have something..
-        # It could be: "True" or "False"
-        # It could be a function call, like: "cos("
-        # or the start some "evil(" function call.
-        #
-        # Check it against our white list of function calls.
-        if part in _ok_whitelist:
-            # good
+def _parse( text ):
+    """
+    Scan text once, splitting it into a tuple of literal strings,
+    _MacroRef() and _MacroCall() objects. Nested references are tracked with an
+    explicit stack, an unclosed "${" is left as literal text.
+    """
+    segments = []
+    stack = []
+    pos = 0
+    for m in _re_token.finditer( text ):
+        start = m.start()
+        if start != pos:
+            segments.append( text[pos:start] )
+        pos = m.end()
+        if pos - start == 2:
+            # an opening "${", collect what follows
+            stack.append( segments )
+            segments = []
             continue
-        
-        # Not recognized
-        return "Illegal: %s" % part
-    # nothing bad found
-    return None
+        if not stack:
+            # a closing "}" without an opening "${"
+            segments.append( '}' )
+            continue
+        parts = segments
+        segments = stack.pop()
+        if (len(parts) == 1) and (parts[0].__class__ is str) and _re_name.match( parts[0] ):
+            # the common case: ${NAME}
+            segments.append( _MacroRef( parts[0] ) )
+            continue
+        call = None
+        if parts:
+            call = _parse_call( parts )
+        if call != None:
+            # a function call: ${dirname(${X})}
+            segments.append( call )
+        elif any( (p.__class__ is not str) for p in parts ):
+            # the name is built from other macros: ${parent_${child}}
+            segments.append( _MacroRef( None, _merge( parts ) ) )
+        else:
+            # not a macro name, like: ${} or ${a b}
+            segments.append( '${' + ''.join( parts ) + '}' )
+    if pos != len(text):
+        segments.append( text[pos:] )
+    # anything still open was never closed
+    while stack:
+        parts = segments
+        segments = stack.pop()
+        segments.append( '${' )
+        segments.extend( parts )
+    return _merge( segments )
 
-@FrozenClass
-class ExpressionEvaluator( object ):
-    '''
-    Given a string, which may contain macros
-    and should contain an expression of some sort..
+def _render( lookup, segments, result, depth, deps = None ):
+    """
+    Join the parsed segments, expanding each macro reference.
+    Returns None (and sets result.err_msg) on error.
+
+    After an error the rest is still expanded, and the last error
+    is reported: the resolver used to replace the last ${...} in
+    the text first, so that is the error it found.
+    """
+    out = []
+    err_msg = None
+    for seg in segments:
+        if seg.__class__ is _MacroRef:
+            seg = _expand( lookup, seg, result, depth, deps )
+        elif seg.__class__ is _MacroCall:
+            seg = _call( lookup, seg, result, depth, deps )
+        if seg == None:
+            err_msg = result.err_msg
+            result.err_msg = None
+        elif err_msg == None:
+            out.append( seg )
+    if err_msg != None:
+        result.err_msg = err_msg
+        return None
+    return ''.join( out )
+
+def _call( lookup, call, result, depth, deps ):
+    """
+    Expand the arguments, then call the function.
+    The function result is not expanded again.
+    """
+    function = call.function
+    if function == None:
+        result.err_msg = "Unknown function: %s()" % call.name
+        result.add_error("unknown function: %s()", call.name)
+        return None
+    args = []
+    err_msg = None
+    for arg in call.args:
+        value = _render( lookup, arg, result, depth, deps )
+        if value == None:
+            # the last error, like _render()
+            result.add_error("in: %s()", call.name)
+            err_msg = result.err_msg
+            result.err_msg = None
+        args.append( value )
+    if err_msg != None:
+        result.err_msg = err_msg
+        return None
+    if (deps != None) and not function.pure:
+        # the value can change, so it must not be cached
+        deps.add( None )
+    try:
+        if function.lookup:
+            value = function.func( lookup, *args )
+        else:
+            value = function.func( *args )
+    except Exception as e:
+        result.err_msg = "Exception: %s() -> %s" % (call.name, e)
+        result.add_error("exception: %s() -> %s", call.name, e)
+        return None
+    if value.__class__ is not str:
+        if not isinstance( value, _str_able_types ):
+            result.err_msg = "Bad result: %s() -> %s" % (call.name, type(value).__name__)
+            result.add_error("bad result: %s()", call.name)
+            return None
+        value = str( value )
+    if result.trace == _TRACE_FULL:
+        result.add_step("call: %s%s -> %s", call.name, tuple( args ), value)
+    return value
+
+# In deps, marks that a DYNAMIC_VOLATILE macro was used
+_NO_MEMO = '$no-memo'
+
+def _reach( result, depth ):
+    """
+    Note the expansion reached depth, False if that is too deep.
+    """
+    if depth > result.pass_max:
+        result.err_msg = "Too many passes"
+        result.add_error("too many passes")
+        return False
+    if depth > result.pass_count:
+        result.pass_count = depth
+    return True
+
+def _expand( lookup, ref, result, depth, deps ):
+    """
+    Expand a single macro reference found at the given recursion depth.
+
+    When values are cached or memoized the names used are collected
+    in deps, a None in deps means something volatile was used, and
+    _NO_MEMO that it must not even be remembered for a batch.
+    """
+    name = ref.name
+    if name == None:
+        name = _render( lookup, ref.parts, result, depth, deps )
+        if name == None:
+            return None
+        if not _re_name.match( name ):
+            # the result is not a macro name, leave it as text
+            return '${' + name + '}'
+
+    # pass counting tracks how deep the expansion goes
+    depth += 1
+    if not _reach( result, depth ):
+        return None
+    if DEBUG:
+        result.add_step("macro: %s (depth: %d)", name, depth )
+    if deps != None:
+        deps.add( name )
+    if lookup._cyclic and lookup._is_cyclic( name ):
+        # validate() found it, no need to go round PASS_MAX times
+        result.err_msg = "Too many passes"
+        result.add_error("cycle: %s", name)
+        return None
+
+    # already expanded in this resolve or batch?
+    memo = result.memo
+    if memo != None:
+        hit = memo.get( name )
+        if hit != None:
+            value, height, volatile = hit
+            if not _reach( result, depth + height ):
+                return None
+            if volatile and (deps != None):
+                deps.add( None )
+            if lookup._stats != None:
+                lookup._stats.hit( name, 'memo' )
+            return value
+
+    cache = lookup.cache
+    if cache != None:
+        hit = cache.get( name )
+        if hit != None:
+            value, height = hit
+            if not _reach( result, depth + height ):
+                return None
+            if result.trace == _TRACE_FULL:
+                result.add_step("cached: %s -> %s", name, value)
+            if memo != None:
+                memo[name] = (value, height, False)
+            if lookup._stats != None:
+                lookup._stats.hit( name, 'cached' )
+            return value
+
+    if lookup._stats == None:
+        value = lookup.lookup( result, name )
+    else:
+        value = lookup._stats.timed_lookup( lookup, result, name )
+    if value == None:
+        return None
+    if (cache == None) and (memo == None):
+        if '$' not in value:
+            return value
+        # the value may itself contain macros
+        value = _render( lookup, _compile( value ).segments, result, depth )
+        if value == None:
+            result.add_error("in: %s", name)
+        elif result.trace == _TRACE_FULL:
+            result.add_step("pass: %d -> %s", depth, value)
+        return value
+
+    volatile = lookup.is_volatile( name )
+    no_memo = volatile and (memo != None) and not lookup._memo_ok( name )
+    height = 0
+    if '$' in value:
+        # expand the value, remembering what it used
+        used = set()
+        outer = result.pass_count
+        result.pass_count = depth
+        value = _render( lookup, _compile( value ).segments, result, depth, used )
+        height = result.pass_count - depth
+        if outer > result.pass_count:
+            result.pass_count = outer
+        if value == None:
+            result.add_error("in: %s", name)
+            return None
+        if result.trace == _TRACE_FULL:
+            result.add_step("pass: %d -> %s", depth, value)
+        if None in used:
+            volatile = True
+            if _NO_MEMO in used:
+                no_memo = True
+        elif (cache != None) and not volatile:
+            cache[name] = (value, height)
+            for n in used:
+                lookup._rdeps.setdefault( n, set() ).add( name )
+    if deps != None:
+        if volatile:
+            deps.add( None )
+        if no_memo:
+            deps.add( _NO_MEMO )
+    if (memo != None) and not no_memo:
+        memo[name] = (value, height, volatile)
+    return value
+
+class CompiledTemplate( object ):
+    """
+    An immutable, parsed template; see MacroResolver.compile().
     
-    Evaluate the expression and return the result.
-    '''
-
-    def __init__(self, macro_resolver = None):
-        if macro_resolver == None:
-            # it is our default value
-            global resolver
-            macro_resolver = resolver
-        assert( isinstance( resolver, MacroResolver ) )
-        self.resolver = macro_resolver
-        
-    def eval( self, text, result = None ):
-        
-        result = self.resolver.resolve( text, result )
-        if result.err_msg != None:
-            result.result = None
-            return result
+    The source text is split once into literal text and macro
+    references, rendering only has to look up the macros.
+    """
+    __slots__ = ('source', 'segments')
+    def __init__( self, source, segments ):
+        object.__setattr__( self, 'source', source )
+        object.__setattr__( self, 'segments', segments )
 
-        if result.result != text:
-            result.add_step("Evalutate: '%s'" % result.result)
+    def __setattr__( self, name, value ):
+        raise AttributeError("CompiledTemplate is immutable")
 
-        result.result = result.result.strip()
-        if len( result.result ) == 0:
-            result.err_msg = "Empty string?"
-            result.result = None
-            return result
-            
-        # is the numeric value safe?
-        result.err_msg = _safe_eval_check( result.result )
-        if result.err_msg != None:
-            result.result = None
+    def render( self, lookup, result = None ):
+        """
+        Resolve the template using the MacroLookup lookup.
+        Returns a MacroResult()
+        """
+        if result == None:
+            result = MacroResult()
+        if lookup._stats != None:
+            return lookup._stats.timed_render( self, lookup, result )
+        return self._render_into( lookup, result )
+
+    def _render_into( self, lookup, result ):
+        if result.trace == _TRACE_FULL:
+            result.add_step("start: %s", self.source )
+        result.err_msg = None
+        result.result  = self.source
+        result.pass_count = 0
+        result.dynamic = None
+
+        # ALL macros have $ signs.
+        if '$' not in self.source:
+            # if no $ signs occur.. we are done
             return result
 
-        # let python do the math
         try:
-            r = eval( result.result )
-            result.result = r
-        except Exception as e:
-            result.add_step("Exception: %s" % str(e) )
-            result.err_msg = "Syntax Error: %s" % str(e)
-            result.result = None
-
-        if result.err_msg != None:
+            text = _render( lookup, self.segments, result, 0 )
+        except RecursionError:
+            result.err_msg = "Too many passes"
+            result.add_error("too many passes")
+            text = None
+        if text == None:
+            # if an error occurred, do not return text.
             result.result = None
-            
+            return result
+        result.result = text
+        if result.trace == _TRACE_FULL:
+            result.add_step("New: %s", text )
         return result
 
-evaluator = ExpressionEvaluator( resolver )
+    def render_many( self, lookups ):
+        """
+        Render the template once for each lookup.
+        Returns a list of MacroResult()
+        """
+        return [ self.render( l ) for l in lookups ]
+
+# render_stream() reads this many characters at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+# and never carries more than this over to the next chunk
+STREAM_CARRY_MAX = 64 * 1024
 
+def _read_chunks( infile, chunk_size, encoding ):
+    """
+    Yield text chunks read from infile, and a final ''.
+    """
+    decoder = None
+    while True:
+        chunk = infile.read( chunk_size )
+        if isinstance( chunk, str ):
+            if not chunk:
+                break
+            yield chunk
+            continue
+        # bytes from a binary stream or mmap
+        if decoder == None:
+            decoder = codecs.getincrementaldecoder( encoding )()
+        text = decoder.decode( chunk, not chunk )
+        if text:
+            yield text
+        if not chunk:
+            break
+    yield ''
+
+def _stream_cut( text ):
+    """
+    Return where the text must be cut so that a "${" is not split
+    from its "}", ie: the start of the outermost unclosed "${"
+    """
+    opened = None
+    nested = 0
+    for m in _re_token.finditer( text ):
+        if m.end() - m.start() == 2:
+            if nested == 0:
+                opened = m.start()
+            nested += 1
+        elif nested:
+            nested -= 1
+    if nested:
+        return opened
+    if text.endswith( '$' ):
+        # this could be the start of a "${"
+        return len(text) - 1
+    return len(text)
+
+def _stream_locate( resolver, text, result ):
+    """
+    Find the offset in text of the macro that failed to resolve,
+    the last one like the error reported, see _render().
+    """
+    opened = 0
+    nested = 0
+    failed = None
+    for m in _re_token.finditer( text ):
+        if m.end() - m.start() == 2:
+            if nested == 0:
+                opened = m.start()
+            nested += 1
+        elif nested:
+            nested -= 1
+            if nested == 0:
+                check = MacroResult( MacroResult.TRACE_OFF )
+                check.pass_max = result.pass_max
+                resolver.resolve( text[opened:m.end()], check )
+                if check.err_msg != None:
+                    failed = opened
+    if failed == None:
+        return opened
+    return failed
+
+def _advance( text, line, column ):
+    """
+    Return the line and column after text.
+    """
+    n = text.count( '\n' )
+    if n == 0:
+        return (line, column + len(text))
+    return (line + n, len(text) - text.rindex( '\n' ))
+
+# Compiled templates are cached, keyed by their text.
+COMPILE_CACHE_MAX = 4096
+# Very large texts are not worth keeping around.
+_COMPILE_TEXT_MAX = 64 * 1024
+
+@functools.lru_cache( maxsize = COMPILE_CACHE_MAX )
+def _compile_cached( text ):
+    return CompiledTemplate( text, _parse( text ) )
+
+def _compile( text ):
+    if len( text ) > _COMPILE_TEXT_MAX:
+        return CompiledTemplate( text, _parse( text ) )
+    return _compile_cached( text )
+
+# these live in expressions.py
+_expression_names = ('ExpressionEvaluator', 'PythonEvalBackend', 'AstEvalBackend')
+
+def __getattr__( name ):
+    """
+    The shared lookup, resolver and evaluator, and the expression
+    classes are found here when first used.
+    """
+    if name in ('lookup', 'resolver', 'evaluator'):
+        return _default( name )
+    if name in _expression_names:
+        from . import expressions
+        return getattr( expressions, name )
+    raise AttributeError( "module %r has no attribute %r" % (__name__, name) )
@@ -0,0 +1,609 @@
+"""
+Expression evaluation, see ExpressionEvaluator.
+
+This is only imported when first used, ie: by envmacros.evaluator
+or envmacros.ExpressionEvaluator, so programs that only resolve
+text do not pay for it.
+"""
+
+import re
+import math
+import ast
+import operator
+import functools
+from frozenclass import FrozenClass
+
+from .envmacros import MacroError, MacroResolver, MacroResult, _TRACE_FULL, _default
+
+__all__ = ['ExpressionEvaluator',
+           'PythonEvalBackend',
+           'AstEvalBackend'
+]
+
+# Expressions are parsed with the ast module and checked
+# against the node types below before they are compiled.
+# Only numbers, True/False, operators and calls to the
+# functions in 'math' are allowed. For example:
+#
+#     "cos(123)*(4 >= ~123) and False < 7"  - is ok
+#     "evil(123)" or "math.cos(1)"         - are not
+
+# All functions in math
+_math_functions = dict()
+for tmp in dir(math):
+    if (tmp[0] != '_') and callable( getattr( math, tmp ) ):
+        _math_functions[tmp] = getattr( math, tmp )
+
+# What expressions are evaluated with, no builtins.
+_eval_globals = dict( _math_functions )
+_eval_globals['__builtins__'] = dict()
+
+_ok_nodes = (
+    ast.Expression, ast.Load,
+    ast.BoolOp, ast.And, ast.Or,
+    ast.UnaryOp, ast.Not, ast.Invert, ast.UAdd, ast.USub,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv,
+    ast.Mod, ast.Pow, ast.LShift, ast.RShift,
+    ast.BitAnd, ast.BitOr, ast.BitXor,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.Call, ast.Name, ast.Constant )
+
+# bool is a subclass of int
+_ok_constants = (int, float)
+
+def _safe_eval_check( tree, text, names = () ):
+    """
+    Returns None if the parsed expression is ok to evaluate.
+    The variables in names are allowed too.
+
+    Returns an error message if the expression is not safe.
+    """
+    calls = set()
+    # ast.walk() visits a Call before its function name
+    for node in ast.walk( tree ):
+        if not isinstance( node, _ok_nodes ):
+            break
+        if isinstance( node, ast.Constant ):
+            if not isinstance( node.value, _ok_constants ):
+                break
+        elif isinstance( node, ast.Call ):
+            func = node.func
+            if (not isinstance( func, ast.Name )) or (func.id not in _math_functions):
+                break
+            if node.keywords:
+                break
+            calls.add( id(func) )
+        elif isinstance( node, ast.Name ):
+            if (id(node) not in calls) and (node.id not in names):
+                break
+    else:
+        # nothing bad found
+        return None
+
+    # Not recognized
+    if isinstance( node, ast.Name ):
+        part = node.id
+    elif isinstance( node, ast.Call ):
+        part = (ast.get_source_segment( text, node.func ) or 'call') + '('
+    else:
+        part = ast.get_source_segment( text, node ) or node.__class__.__name__
+    return "Illegal: %s" % part
+
+# Parsed and compiled expressions are cached, keyed by their text.
+EVAL_CACHE_MAX = 4096
+
+@functools.lru_cache( maxsize = EVAL_CACHE_MAX )
+def _parse_expression( text ):
+    """
+    Returns (checked ast tree, None) or (None, error message)
+    """
+    try:
+        tree = ast.parse( text, '<string>', 'eval' )
+    except Exception as e:
+        return (None, "Syntax Error: %s" % str(e))
+    err_msg = _safe_eval_check( tree, text )
+    if err_msg != None:
+        return (None, err_msg)
+    return (tree, None)
+
+@functools.lru_cache( maxsize = EVAL_CACHE_MAX )
+def _compile_expression( text ):
+    """
+    Returns (code, None) or (None, error message)
+    """
+    tree, err_msg = _parse_expression( text )
+    if err_msg != None:
+        return (None, err_msg)
+    return (compile( tree, '<string>', 'eval' ), None)
+
+class PythonEvalBackend( object ):
+    """
+    Evaluate checked expressions with python's eval().
+    """
+    def evaluate( self, text ):
+        """
+        Return the value of text, raises MacroError if
+        the expression is not allowed.
+        """
+        code, err_msg = _compile_expression( text )
+        if err_msg != None:
+            raise MacroError( err_msg )
+        return eval( code, _eval_globals )
+
+_bin_ops = {
+    ast.Add      : operator.add,
+    ast.Sub      : operator.sub,
+    ast.Mult     : operator.mul,
+    ast.Div      : operator.truediv,
+    ast.FloorDiv : operator.floordiv,
+    ast.Mod      : operator.mod,
+    ast.Pow      : operator.pow,
+    ast.LShift   : operator.lshift,
+    ast.RShift   : operator.rshift,
+    ast.BitAnd   : operator.and_,
+    ast.BitOr    : operator.or_,
+    ast.BitXor   : operator.xor,
+}
+
+_unary_ops = {
+    ast.Not    : operator.not_,
+    ast.Invert : operator.invert,
+    ast.UAdd   : operator.pos,
+    ast.USub   : operator.neg,
+}
+
+_compare_ops = {
+    ast.Eq    : operator.eq,
+    ast.NotEq : operator.ne,
+    ast.Lt    : operator.lt,
+    ast.LtE   : operator.le,
+    ast.Gt    : operator.gt,
+    ast.GtE   : operator.ge,
+}
+
+# math functions whose result grows with the value of the parameter
+_math_growing = ('factorial', 'comb', 'perm')
+
+class AstEvalBackend( object ):
+    """
+    Evaluate checked expressions by walking the ast tree,
+    without python's eval().
+
+    Integers are limited to max_int_bits, so something
+    like 9**9**9 fails quickly instead of pinning a core,
+    and the tree may not be nested deeper than max_depth.
+    """
+    MAX_INT_BITS = 4096
+    MAX_DEPTH = 100
+    def __init__( self, max_int_bits = None, max_depth = None ):
+        if max_int_bits == None:
+            max_int_bits = self.MAX_INT_BITS
+        if max_depth == None:
+            max_depth = self.MAX_DEPTH
+        self.max_int_bits = max_int_bits
+        self.max_depth = max_depth
+
+    def evaluate( self, text ):
+        """
+        Return the value of text, raises MacroError if
+        the expression is not allowed or too large.
+        """
+        tree, err_msg = _parse_expression( text )
+        if err_msg != None:
+            raise MacroError( err_msg )
+        return self._eval( tree.body, 1 )
+
+    def _too_large( self, what ):
+        raise MacroError( "Too large: %s exceeds %d bits" % (what, self.max_int_bits) )
+
+    def _eval( self, node, depth ):
+        if depth > self.max_depth:
+            raise MacroError( "Too deep: more than %d levels" % self.max_depth )
+        depth += 1
+        cls = node.__class__
+        if cls is ast.Constant:
+            return node.value
+
+        if cls is ast.BinOp:
+            a = self._eval( node.left, depth )
+            b = self._eval( node.right, depth )
+            op = node.op.__class__
+            # bools too, ie: (1==1) << 100000
+            if isinstance( a, int ) and isinstance( b, int ):
+                limit = self.max_int_bits
+                if op is ast.LShift:
+                    if (b > 0) and (a.bit_length() + b > limit):
+                        self._too_large( '<<' )
+                elif op is ast.Pow:
+                    # a**b has about log2(|a|)*b bits
+                    if (b > 0) and (abs( a ) > 1) and (math.log2( abs( a ) ) * b > limit):
+                        self._too_large( '**' )
+                elif op is ast.Mult:
+                    if a.bit_length() + b.bit_length() > limit:
+                        self._too_large( '*' )
+            return _bin_ops[op]( a, b )
+
+        if cls is ast.UnaryOp:
+            return _unary_ops[node.op.__class__]( self._eval( node.operand, depth ) )
+
+        if cls is ast.BoolOp:
+            # like python, return the deciding value
+            is_and = node.op.__class__ is ast.And
+            for value in node.values:
+                v = self._eval( value, depth )
+                if is_and != bool( v ):
+                    break
+            return v
+
+        if cls is ast.Compare:
+            a = self._eval( node.left, depth )
+            for op, right in zip( node.ops, node.comparators ):
+                b = self._eval( right, depth )
+                if not _compare_ops[op.__class__]( a, b ):
+                    return False
+                a = b
+            return True
+
+        if cls is ast.Call:
+            name = node.func.id
+            args = [ self._eval( arg, depth ) for arg in node.args ]
+            for arg in args:
+                if isinstance( arg, int ):
+                    if arg.bit_length() > self.max_int_bits:
+                        self._too_large( name + '()' )
+                    if (name in _math_growing) and (arg > self.max_int_bits):
+                        self._too_large( name + '()' )
+            value = _math_functions[name]( *args )
+            if isinstance( value, int ) and (value.bit_length() > self.max_int_bits):
+                self._too_large( name + '()' )
+            return value
+
+        # _safe_eval_check() does not allow anything else
+        raise MacroError( "Illegal: %s" % cls.__name__ )
+
+# NumPy is optional, and slow to import: see _numpy()
+_numpy_module = None
+# what vectorized expressions are evaluated with, see _numpy_globals()
+_numpy_globals_ = None
+
+def _numpy():
+    """
+    Return the numpy module, or None if it is not installed.
+    """
+    global _numpy_module
+    if _numpy_module == None:
+        try:
+            import numpy
+            _numpy_module = numpy
+        except ImportError:
+            _numpy_module = False
+    return _numpy_module or None
+
+# math functions that have another name in numpy
+_numpy_names = {
+    'asin'  : 'arcsin',  'acos'  : 'arccos',  'atan'  : 'arctan',
+    'asinh' : 'arcsinh', 'acosh' : 'arccosh', 'atanh' : 'arctanh',
+    'atan2' : 'arctan2', 'pow'   : 'float_power' }
+
+def _numpy_globals( np ):
+    """
+    The math functions as numpy ufuncs, where numpy has them,
+    plus the helpers that _VectorizeBool() calls.
+    """
+    global _numpy_globals_
+    if _numpy_globals_ == None:
+        g = dict()
+        for name, func in _math_functions.items():
+            ufunc = getattr( np, _numpy_names.get( name, name ), None )
+            if not isinstance( ufunc, np.ufunc ):
+                # no equivalent, call it for each value
+                ufunc = np.vectorize( func )
+            g[name] = ufunc
+        # np.log( x, y ) would write the result into y
+        g['log'] = lambda x, base = None: np.log( x ) if (base == None) else (np.log( x ) / np.log( base ))
+        # like python's "and" and "or", one value at a time
+        g['_v_and'] = lambda a, b: np.where( a, b, a )
+        g['_v_or']  = lambda a, b: np.where( a, a, b )
+        g['_v_not'] = np.logical_not
+        # numpy integers wrap around, see _VectorizeInt
+        for name, ops in _int_ops.items():
+            g[name] = _int_checked( np, ops )
+        g['__builtins__'] = dict()
+        _numpy_globals_ = g
+    return _numpy_globals_
+
+# what _VectorizeInt checks, the operators that can overflow:
+# name -> (the operator, the same with floats)
+_int_ops = {
+    '_v_add'    : (operator.add, operator.add),
+    '_v_sub'    : (operator.sub, operator.sub),
+    '_v_mul'    : (operator.mul, operator.mul),
+    '_v_pow'    : (operator.pow, operator.pow),
+    '_v_lshift' : (operator.lshift, lambda a, b: a * (2.0 ** b)),
+    '_v_neg'    : (operator.neg, operator.neg),
+}
+_int_op_names = {
+    ast.Add    : '_v_add',
+    ast.Sub    : '_v_sub',
+    ast.Mult   : '_v_mul',
+    ast.Pow    : '_v_pow',
+    ast.LShift : '_v_lshift',
+}
+
+def _int_checked( np, ops ):
+    """
+    Return op( a, ... ) that raises MacroError when an integer array
+    result does not fit, the same op with floats tells the size.
+    """
+    op, float_op = ops
+    def checked( *args ):
+        value = op( *args )
+        if (not isinstance( value, np.ndarray )) or (value.dtype.kind not in 'iu'):
+            return value
+        with np.errstate( over = 'ignore', invalid = 'ignore' ):
+            size = float_op( *[ np.asarray( a, dtype = float ) for a in args ] )
+        info = np.iinfo( value.dtype )
+        # both limits are powers of 2, exact as floats; a value very
+        # close to a limit can round up to it and be reported too
+        if np.any( size >= float( info.max + 1 ) ) or np.any( size < float( info.min ) ):
+            raise MacroError( "Too large: integer overflow, more than %d bits" % info.bits )
+        return value
+    return checked
+
+class _VectorizeInt( ast.NodeTransformer ):
+    """
+    +, -, *, ** and << (and unary -) on numpy integers wrap around
+    without an error, so they become calls to _v_add() etc, which check.
+    """
+    def visit_BinOp( self, node ):
+        self.generic_visit( node )
+        name = _int_op_names.get( type( node.op ) )
+        if name == None:
+            return node
+        return ast.Call( ast.Name( name, ast.Load() ), [ node.left, node.right ], [] )
+
+    def visit_UnaryOp( self, node ):
+        self.generic_visit( node )
+        if not isinstance( node.op, ast.USub ):
+            return node
+        return ast.Call( ast.Name( '_v_neg', ast.Load() ), [ node.operand ], [] )
+
+class _VectorizeBool( ast.NodeTransformer ):
+    """
+    "and", "or", "not" and chained compares like a < b < c
+    need a single True or False, so with arrays they become
+    calls to _v_and(), _v_or() and _v_not()
+    """
+    def _call( self, name, args ):
+        return ast.Call( ast.Name( name, ast.Load() ), args, [] )
+
+    def visit_BoolOp( self, node ):
+        self.generic_visit( node )
+        name = '_v_and' if isinstance( node.op, ast.And ) else '_v_or'
+        value = node.values[0]
+        for v in node.values[1:]:
+            value = self._call( name, [ value, v ] )
+        return value
+
+    def visit_UnaryOp( self, node ):
+        self.generic_visit( node )
+        if isinstance( node.op, ast.Not ):
+            return self._call( '_v_not', [ node.operand ] )
+        return node
+
+    def visit_Compare( self, node ):
+        self.generic_visit( node )
+        if len( node.ops ) == 1:
+            return node
+        left = node.left
+        value = None
+        for op, right in zip( node.ops, node.comparators ):
+            test = ast.Compare( left, [ op ], [ right ] )
+            value = test if (value == None) else self._call( '_v_and', [ value, test ] )
+            left = right
+        return value
+
+# Column placeholders, see ExpressionEvaluator.eval_vectorized()
+_re_column = re.compile( r'_v_col[0-9]+' )
+
+@FrozenClass
+class ExpressionEvaluator( object ):
+    '''
+    Given a string, which may contain macros
+    and should contain an expression of some sort..
+    
+    Evaluate the expression and return the result.
+
+    The backend does the math, it can be "python" (the default)
+    which uses python's eval(), "ast" which walks the parsed
+    expression and limits integer sizes, or any object with
+    an evaluate( text ) method like PythonEvalBackend().
+    '''
+    BACKEND_PYTHON = 'python'
+    BACKEND_AST    = 'ast'
+
+    def __init__(self, macro_resolver = None, backend = None):
+        if macro_resolver == None:
+            # it is our default value
+            macro_resolver = _default( 'resolver' )
+        assert( isinstance( macro_resolver, MacroResolver ) )
+        self.resolver = macro_resolver
+        if (backend == None) or (backend == self.BACKEND_PYTHON):
+            backend = PythonEvalBackend()
+        elif backend == self.BACKEND_AST:
+            backend = AstEvalBackend()
+        assert( hasattr( backend, 'evaluate' ) )
+        self.backend = backend
+        
+    def eval_many( self, texts, errors = None ):
+        """
+        Evaluate each text from the iterable texts, yielding
+        the value, or None if there was an error.
+
+        If errors is a dict, errors[index] = err_msg is set
+        for each text that failed.
+
+        Like MacroResolver.resolve_many() each macro is looked
+        up once for the whole batch.
+        """
+        result = MacroResult( self.resolver.trace )
+        result.memo = dict()
+        for index, text in enumerate( texts ):
+            result.reset()
+            self.eval( text, result )
+            if (result.err_msg != None) and (errors != None):
+                errors[index] = result.err_msg
+            yield result.result
+
+    def eval( self, text, result = None ):
+        return self._evaluate( text, self.resolver.resolve( text, result ) )
+
+    def eval_vectorized( self, text, columns, result = None ):
+        """
+        Evaluate text once for each row of columns, a dict of:
+            macro name -> sequence of values (all the same length)
+        In row N, ${name} is columns[name][N] and other macros
+        come from the resolver as usual.
+
+        The expression is resolved and checked once. With NumPy the
+        columns become arrays and the math functions are their ufunc
+        equivalents, so all rows are computed at once; values then
+        follow NumPy's rules (ie: fixed size integers, an overflow
+        or a division by zero is an error). Without NumPy, or with
+        a backend other than 'python', each row is evaluated with
+        the backend.
+
+        result.result is a numpy array or a list, one value per row.
+        """
+        if result == None:
+            result = MacroResult( self.resolver.trace )
+        if not columns:
+            raise MacroError( "No columns" )
+        rows = None
+        for name, values in columns.items():
+            if rows == None:
+                rows = len( values )
+            elif len( values ) != rows:
+                raise MacroError( "Column length: %s has %d rows, not %d" % (name, len( values ), rows) )
+
+        # resolve with each column as a variable
+        scope = self.resolver.lookup.child()
+        variables = dict()
+        for n, name in enumerate( columns ):
+            placeholder = '_v_col%d' % n
+            scope.add( name, placeholder )
+            variables[placeholder] = columns[name]
+        self.resolver.compile( text ).render( scope, result )
+        if result.err_msg != None:
+            result.result = None
+            return result
+        expr = result.result.strip()
+        if result.trace == _TRACE_FULL:
+            result.add_step("Vectorized: '%s'", expr)
+
+        try:
+            tree = ast.parse( expr, '<string>', 'eval' )
+        except Exception as e:
+            result.err_msg = "Syntax Error: %s" % str(e)
+            result.result = None
+            return result
+        result.err_msg = _safe_eval_check( tree, expr, variables )
+        if result.err_msg != None:
+            result.result = None
+            return result
+
+        np = _numpy()
+        try:
+            # other backends have limits of their own, see _eval_rows()
+            if (np != None) and isinstance( self.backend, PythonEvalBackend ):
+                result.result = self._eval_numpy( np, tree, variables, rows )
+            else:
+                result.result = self._eval_rows( tree, expr, variables, rows )
+        except MacroError as e:
+            result.err_msg = str(e)
+        except Exception as e:
+            result.add_error("Exception: %s", str(e) )
+            result.err_msg = "Syntax Error: %s" % str(e)
+        if result.err_msg != None:
+            result.result = None
+        return result
+
+    def _eval_numpy( self, np, tree, variables, rows ):
+        tree = _VectorizeInt().visit( _VectorizeBool().visit( tree ) )
+        code = compile( ast.fix_missing_locations( tree ), '<string>', 'eval' )
+        arrays = dict( (n, np.asarray( v )) for n, v in variables.items() )
+        # FloatingPointError, like ZeroDivisionError without numpy
+        with np.errstate( all = 'raise' ):
+            value = eval( code, _numpy_globals( np ), arrays )
+            if np.ndim( value ) == 0:
+                # it did not use the columns
+                value = np.full( rows, value )
+        return value
+
+    def _eval_rows( self, tree, expr, variables, rows ):
+        names = list( variables )
+        if isinstance( self.backend, PythonEvalBackend ):
+            # the same checked code, with different variables
+            code = compile( tree, '<string>', 'eval' )
+            row = dict()
+            values = []
+            for x in range( rows ):
+                for n in names:
+                    row[n] = variables[n][x]
+                values.append( eval( code, _eval_globals, row ) )
+            return values
+        # other backends only take text
+        def literal( m ):
+            value = variables[m.group()][x]
+            if hasattr( value, 'item' ):
+                # a numpy scalar, repr() would be: np.int64(1)
+                value = value.item()
+            return '(%r)' % (value,)
+        values = []
+        for x in range( rows ):
+            text = _re_column.sub( literal, expr )
+            values.append( self.backend.evaluate( text ) )
+        return values
+
+    async def aeval( self, text, result = None ):
+        """
+        Like eval(), for use with async dynamic macros.
+        See MacroResolver.aresolve()
+        """
+        return self._evaluate( text, await self.resolver.aresolve( text, result ) )
+
+    def _evaluate( self, text, result ):
+        """
+        Evaluate the resolved text in result.
+        """
+        if result.err_msg != None:
+            result.result = None
+            return result
+
+        if (result.trace == _TRACE_FULL) and (result.result != text):
+            result.add_step("Evalutate: '%s'", result.result)
+
+        result.result = result.result.strip()
+        if len( result.result ) == 0:
+            result.err_msg = "Empty string?"
+            result.result = None
+            return result
+            
+        # let the backend check and do the math
+        stats = self.resolver.lookup._stats
+        try:
+            if stats == None:
+                r = self.backend.evaluate( result.result )
+            else:
+                r = stats.timed_evaluate( self.backend, result.result )
+            result.result = r
+        except MacroError as e:
+            result.err_msg = str(e)
+        except Exception as e:
+            result.add_error("Exception: %s", str(e) )
+            result.err_msg = "Syntax Error: %s" % str(e)
+
+        if result.err_msg != None:
+            result.result = None
+            
+        return result
@@ -8,10 +8,9 @@ import os
 import sys
 import re
 
-from .envmacros import MacroLookup
-from .envmacros import MacroResult
+from .envmacros import MacroLookup, _where_base, _where_text, _WHERE_LINE_MASK
 
-__all__ = ['MacroSyntax', 'MacroDuplicate', 'read_text_varfile' ]
+__all__ = ['MacroSyntax', 'MacroDuplicate', 'read_text_varfile', 'read_text_varfiles' ]
 
 class MacroSyntax( Exception ):
     pass
@@ -19,37 +18,112 @@ class MacroSyntax( Exception ):
 class MacroDuplicate( Exception ):
     pass
     
-_re_macro = re.compile( r'^\s*(?P<name>[A-Za-z_][A-Za-z0-9_]*)\s*=\s*(?P<value>.*)$' )
+# A macro name, C (or python) style: the NAME in NAME = value
+_re_name = re.compile( r'[A-Za-z_][A-Za-z0-9_]*$' )
 
-def read_text_varfile( filename, lookup ):
-    assert( isinstance( lookup, MacroLookup ) )
-    result = MacroResult()
-    
+def _parse_text_varfile( filename, text = None, base = 0 ):
+    """
+    Parse the file (or its text) in one pass, returning a dict of:
+        name -> (value, where)
+    where is base plus the line number, see _where_base()
+    """
+    found = dict()
     # slurp the lines
-    with open( filename, 'r' ) as f:
-        lines = f.read().splitlines()
+    if text == None:
+        with open( filename, 'r' ) as f:
+            text = f.read()
+    lines = text.splitlines()
     
     # parse the lines
-    for lineno, line in enumerate( lines ):
-        # 1 based, not 0 based
-        lineno += 1
+    for lineno, line in enumerate( lines, 1 ):
         line = line.strip()
         if len(line) == 0:
             continue
         if line[0] == '#':
             continue
-        # look for macros
-        m = _re_macro.match( line )
-        if m == None:
+        # look for: NAME = value
+        n, eq, v = line.partition( '=' )
+        n = n.rstrip()
+        if (not eq) or (_re_name.match( n ) == None):
             raise MacroSyntax( "%s:%d: syntax: %s" % (filename,lineno,line))
-        n = m.group('name')
-        v = m.group('value')
-        v = v.strip()
-        w = '%s:%d' % (filename,lineno)
-        existing = lookup.lookup( result, n )
-        if existing != None:
-            msg = "%s:%s: Duplicate %s, previous: %s" % (filename,lineno,n, result.where )
-            raise MacroDuplicate(msg) 
-            
-        lookup.add( n,v, w )
-    
+        if n in found:
+            previous = found[n][1] & _WHERE_LINE_MASK
+            msg = "%s:%s: Duplicate %s, previous: %s:%d" % (filename,lineno,n,filename,previous )
+            raise MacroDuplicate(msg)
+        found[n] = (v.strip(), base + lineno)
+    return found
+
+def _rebase( found, base ):
+    """
+    Add base to the line numbers of the entries.
+    """
+    return { n : (v, base + lineno) for n, (v, lineno) in found.items() }
+
+def _load_entries( found, lookup ):
+    """
+    Add the parsed entries to the lookup, checking for
+    duplicates against what the lookup already has.
+    """
+    duplicates = found.keys() & lookup.entries.keys()
+    if duplicates:
+        # report the first one in the file
+        for n, (v, where) in found.items():
+            if n in duplicates:
+                msg = "%s: Duplicate %s, previous: %s" % (_where_text( where ),n,_where_text( lookup.entries[n][1] ) )
+                raise MacroDuplicate(msg) 
+    lookup.update( found )
+
+def _read_found( filename, cache, base ):
+    if cache:
+        from . import varfile_cache
+        # the cache keeps line numbers, file ids are per process
+        return _rebase( varfile_cache.load_cached( filename, cache, _parse_text_varfile ), base )
+    return _parse_text_varfile( filename, None, base )
+
+def read_text_varfile( filename, lookup, cache = None ):
+    """
+    Read NAME = value lines from filename into the MacroLookup lookup.
+
+    Blank lines and # comments are ignored. Raises MacroSyntax for
+    other lines and MacroDuplicate if a name is already defined,
+    either in the file or in lookup.entries (not os.environ).
+
+    With cache=True the parsed file is cached next to the file,
+    or cache can be the name of a directory to keep the cache in.
+    """
+    assert( isinstance( lookup, MacroLookup ) )
+    _load_entries( _read_found( filename, cache, _where_base( filename ) ), lookup )
+
+def read_text_varfiles( filenames, lookup, workers = None, cache = None, processes = False ):
+    """
+    Read several text varfiles into the MacroLookup lookup.
+
+    The files are parsed at the same time by a pool of workers
+    threads (or processes if processes=True), then added to the
+    lookup in the order given. Errors are the same as calling
+    read_text_varfile() on each file in turn.
+    """
+    assert( isinstance( lookup, MacroLookup ) )
+    filenames = list( filenames )
+    if workers == None:
+        workers = os.cpu_count() or 1
+    workers = min( workers, len(filenames) )
+    if workers <= 1:
+        for filename in filenames:
+            _load_entries( _read_found( filename, cache, _where_base( filename ) ), lookup )
+        return
+
+    import concurrent.futures
+    if processes:
+        pool = concurrent.futures.ProcessPoolExecutor( workers )
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor( workers )
+    with pool:
+        futures = [ pool.submit( _read_found, filename, cache, _where_base( filename ) )
+                    for filename in filenames ]
+        try:
+            for future in futures:
+                _load_entries( future.result(), lookup )
+        finally:
+            for future in futures:
+                future.cancel()
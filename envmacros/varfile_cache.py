@@ -0,0 +1,91 @@
+"""
+This module keeps an on-disk cache of parsed text varfiles,
+so that a process starting up does not have to parse an
+unchanged file again. See: read_text_varfile( ..., cache=True )
+
+The cache file holds the parsed entries (with line numbers
+as the where of each entry) as a marshal blob,
+and is only used if the varfile size, mtime and content hash
+all still match. Anything else (a stale, corrupt or unwritable
+cache file) quietly falls back to parsing the varfile.
+"""
+
+import os
+import io
+import marshal
+import hashlib
+
+# change this if the layout of the cache changes
+_MAGIC = b'envmacros-varfile-2\n'
+
+def _digest( data ):
+    return hashlib.blake2b( data, digest_size = 16 ).digest()
+
+def cache_filename( filename, cache ):
+    """
+    Where the cache for filename lives.
+
+    If cache is True, it is next to the file: ".NAME.envcache"
+    otherwise cache is the directory to keep cache files in.
+    """
+    if cache is True:
+        d, b = os.path.split( filename )
+        return os.path.join( d, '.' + b + '.envcache' )
+    name = hashlib.blake2b( os.path.abspath( filename ).encode( 'utf-8' ), digest_size = 16 )
+    return os.path.join( cache, name.hexdigest() + '.envcache' )
+
+def _read_cache( cname, filename, st, data ):
+    """
+    Return the cached entries, or None if the cache is not valid.
+    """
+    try:
+        with open( cname, 'rb' ) as f:
+            blob = f.read()
+    except OSError:
+        return None
+    if not blob.startswith( _MAGIC ):
+        return None
+    try:
+        header, found = marshal.loads( blob[len(_MAGIC):] )
+    except (ValueError, EOFError, TypeError):
+        # corrupt
+        return None
+    if header != (filename, st.st_size, st.st_mtime_ns, _digest( data )):
+        # stale
+        return None
+    if not isinstance( found, dict ):
+        return None
+    return found
+
+def _write_cache( cname, filename, st, data, found ):
+    header = (filename, st.st_size, st.st_mtime_ns, _digest( data ))
+    tmp = '%s.%d.tmp' % (cname, os.getpid())
+    try:
+        with open( tmp, 'wb' ) as f:
+            f.write( _MAGIC )
+            f.write( marshal.dumps( (header, found) ) )
+        os.replace( tmp, cname )
+    except OSError:
+        # not writable? then we do without
+        try:
+            os.remove( tmp )
+        except OSError:
+            pass
+
+def load_cached( filename, cache, parse ):
+    """
+    Return the parsed entries of filename, from the cache if valid,
+    otherwise parse( filename, text ) is called and the result saved.
+    """
+    with open( filename, 'rb' ) as f:
+        st = os.fstat( f.fileno() )
+        data = f.read()
+    cname = cache_filename( filename, cache )
+    found = _read_cache( cname, filename, st, data )
+    if found != None:
+        return found
+    # decode like open( filename, 'r' ) would
+    text = io.TextIOWrapper( io.BytesIO( data ) ).read()
+    found = parse( filename, text )
+    _write_cache( cname, filename, st, data, found )
+    return found
@@ -0,0 +1,273 @@
+"""
+This module reloads text varfiles into a live MacroLookup,
+see VarfileReloader. Only the files that changed are parsed
+again, and only the names that changed are updated.
+"""
+
+import os
+import io
+import sys
+import select
+import threading
+
+from frozenclass import FrozenClass
+
+from .envmacros import MacroLookup, _where_base, _where_text
+from .text_varfile import MacroDuplicate, _parse_text_varfile
+from .varfile_cache import _digest
+
+__all__ = ['VarfileReloader']
+
+class _FileState( object ):
+    """
+    What a varfile held when it was last loaded.
+    """
+    __slots__ = ('size', 'mtime_ns', 'digest', 'found')
+    def __init__( self, size, mtime_ns, digest, found ):
+        self.size     = size
+        self.mtime_ns = mtime_ns
+        self.digest   = digest
+        # name -> (value, where)
+        self.found    = found
+
+# An empty (or missing) file
+_NO_FILE = _FileState( None, None, None, dict() )
+
+@FrozenClass
+class VarfileReloader( object ):
+    """
+    Keep a MacroLookup up to date with a set of text varfiles.
+
+        reloader = envmacros.VarfileReloader( lookup, [ 'a.txt', 'b.txt' ] )
+        reloader.subscribe( on_change )
+        reloader.reload()           # the first time loads every file
+        ...
+        reloader.reload()           # ie: on SIGHUP, or see watch()
+
+    reload() checks the size and mtime of each file, and a hash of
+    the ones that look different. A changed file is parsed again
+    and its entries compared with the previous load: only names
+    that were added, changed or removed are applied to the lookup,
+    so the lookup cache keeps everything else.
+
+    Subscribers are called as: callback( added, changed, removed )
+    with three sets of names, when something changed.
+
+    Errors are the same as read_text_varfile(), when a file has an
+    error nothing is applied, and the next reload() tries again.
+    A file that is missing is the same as an empty file.
+    """
+    def __init__( self, lookup, filenames = () ):
+        assert( isinstance( lookup, MacroLookup ) )
+        self.lookup = lookup
+        # filename -> _FileState, in the order given
+        self.files = dict()
+        # name -> filename that defines it
+        self.owner = dict()
+        self.subscribers = []
+        for filename in filenames:
+            self.add_file( filename )
+
+    def add_file( self, filename ):
+        """
+        Add a varfile, it is loaded by the next reload().
+        """
+        if filename not in self.files:
+            self.files[filename] = _NO_FILE
+
+    def subscribe( self, callback ):
+        """
+        Call callback( added, changed, removed ) after a reload()
+        that changed something.
+        """
+        self.subscribers.append( callback )
+
+    def unsubscribe( self, callback ):
+        self.subscribers.remove( callback )
+
+    def _check( self, filename, state ):
+        """
+        Return a new _FileState if filename changed, otherwise None.
+        """
+        try:
+            with open( filename, 'rb' ) as f:
+                st = os.fstat( f.fileno() )
+                if (st.st_size == state.size) and (st.st_mtime_ns == state.mtime_ns):
+                    return None
+                data = f.read()
+        except FileNotFoundError:
+            if state is _NO_FILE:
+                return None
+            return _NO_FILE
+        digest = _digest( data )
+        if digest == state.digest:
+            # touched, but the same
+            return _FileState( st.st_size, st.st_mtime_ns, digest, state.found )
+        # decode like open( filename, 'r' ) would
+        text = io.TextIOWrapper( io.BytesIO( data ) ).read()
+        found = _parse_text_varfile( filename, text, _where_base( filename ) )
+        return _FileState( st.st_size, st.st_mtime_ns, digest, found )
+
+    def reload( self ):
+        """
+        Load the varfiles that changed since the last reload().
+        Returns (added, changed, removed), three sets of names.
+        """
+        # parse everything first, so an error changes nothing
+        updates = []
+        # name -> the file it is no longer in
+        removed_from = dict()
+        for filename, state in self.files.items():
+            new = self._check( filename, state )
+            if new == None:
+                continue
+            updates.append( (filename, state, new) )
+            for n in state.found:
+                if n not in new.found:
+                    removed_from[n] = filename
+
+        added = set()
+        changed = set()
+        entries = dict()
+        owner = dict()
+        for filename, state, new in updates:
+            old = state.found
+            for n, tuple_ in new.found.items():
+                previous = old.get( n )
+                if previous == None:
+                    self._check_duplicate( n, tuple_, owner, entries, removed_from )
+                    owner[n] = filename
+                    if n not in removed_from:
+                        added.add( n )
+                        entries[n] = tuple_
+                        continue
+                    # it moved here from another file
+                    previous = self.lookup.entries[n]
+                if previous[0] != tuple_[0]:
+                    changed.add( n )
+                elif previous[1] == tuple_[1]:
+                    continue
+                # a new value, or it moved to another line
+                entries[n] = tuple_
+        removed = set( n for n in removed_from if n not in owner )
+
+        for n in removed:
+            self.lookup.remove( n )
+            del self.owner[n]
+        self.lookup.update( entries )
+        self.owner.update( owner )
+        for filename, state, new in updates:
+            self.files[filename] = new
+
+        if added or changed or removed:
+            for callback in list( self.subscribers ):
+                callback( added, changed, removed )
+        return (added, changed, removed)
+
+    def _check_duplicate( self, name, tuple_, owner, entries, removed_from ):
+        """
+        Raise MacroDuplicate if name, new in a file, is defined elsewhere.
+        """
+        if name in owner:
+            # by another file in this reload
+            previous = entries.get( name ) or self.lookup.entries[name]
+        elif name in removed_from:
+            # the other file no longer has it
+            return
+        elif name in self.lookup.entries:
+            # by another file, or not by a file
+            previous = self.lookup.entries[name]
+        else:
+            return
+        msg = "%s: Duplicate %s, previous: %s" % (_where_text( tuple_[1] ), name, _where_text( previous[1] ))
+        raise MacroDuplicate( msg )
+
+    def watch( self, interval = 1.0, stop = None, on_error = None, use_inotify = True ):
+        """
+        Call reload() until the threading.Event stop is set,
+        ie: in a thread of its own.
+
+        On Linux inotify is used to reload soon after a file in
+        the same directory changes, otherwise (or if use_inotify
+        is False) the files are checked every interval seconds.
+        Exceptions from reload() are passed to on_error( e ),
+        without an on_error they are raised.
+        """
+        if stop == None:
+            stop = threading.Event()
+        notify = None
+        if use_inotify:
+            notify = _inotify( self.files )
+        try:
+            while not stop.is_set():
+                try:
+                    self.reload()
+                except Exception as e:
+                    if on_error == None:
+                        raise
+                    on_error( e )
+                if notify != None:
+                    notify.wait( interval )
+                else:
+                    stop.wait( interval )
+        finally:
+            if notify != None:
+                notify.close()
+
+class _Inotify( object ):
+    """
+    Wait for changes to directories with linux inotify.
+    """
+    # from: sys/inotify.h
+    IN_MODIFY      = 0x002
+    IN_ATTRIB      = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM  = 0x040
+    IN_MOVED_TO    = 0x080
+    IN_CREATE      = 0x100
+    IN_DELETE      = 0x200
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+    def __init__( self, libc, directories ):
+        self.fd = libc.inotify_init1( os.O_NONBLOCK | os.O_CLOEXEC )
+        if self.fd < 0:
+            raise OSError( "inotify_init1() failed" )
+        for d in directories:
+            if libc.inotify_add_watch( self.fd, os.fsencode( d ), self.MASK ) < 0:
+                os.close( self.fd )
+                raise OSError( "inotify_add_watch() failed: %s" % d )
+
+    def wait( self, timeout ):
+        """
+        Wait up to timeout seconds for a change, True if one happened.
+        """
+        ready = select.select( [ self.fd ], [], [], timeout )[0]
+        if not ready:
+            return False
+        # what changed does not matter, reload() looks
+        try:
+            while os.read( self.fd, 64 * 1024 ):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close( self ):
+        os.close( self.fd )
+
+def _inotify( filenames ):
+    """
+    Return an _Inotify() for the directories of filenames,
+    or None if inotify is not available.
+    """
+    if not sys.platform.startswith( 'linux' ):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL( ctypes.util.find_library( 'c' ) or 'libc.so.6', use_errno = True )
+        directories = set( os.path.dirname( os.path.abspath( f ) ) for f in filenames )
+        return _Inotify( libc, [ d for d in directories if os.path.isdir( d ) ] )
+    except (OSError, AttributeError):
+        return None
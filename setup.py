@@ -13,6 +13,9 @@ setup( name='envmacros',
        platforms='any',
        test_suite='tests',
        packages=['envmacros'],
+       entry_points={
+           'console_scripts': [ 'envmacros-bench=envmacros.bench:main' ]
+           },
        install_requires=[
            'frozenclass>=1'
            ]
@@ -2,6 +2,7 @@ from unittest import TestCase
 import sys
 import envmacros
 import os
+import time
 
 # change this to debug things
 VERBOSE=False
@@ -32,6 +33,9 @@ def create_resolver():
     resolver.lookup.add( "bad_macro", "${bad_macro" )
     return resolver
 
+def entry( lookup, name ):
+    return ( lookup.entries[name][0], lookup.where( name ) )
+
 def create_eval():
     r = create_resolver()
     e = envmacros.ExpressionEvaluator( r )
@@ -121,6 +125,145 @@ class MyTest( TestCase ):
         self.assertNotEqual( mr.err_msg, None )
         print_result(mr)
 
+    def test_110_many_references(self):
+        # More references than PASS_MAX is not recursion.
+        r = create_resolver()
+        n = envmacros.MacroResult.PASS_MAX * 3
+        mr = r.resolve( '${dog},' * n )
+        self.assertEqual( mr.err_msg, None )
+        self.assertEqual( mr.result, 'Dolly,' * n )
+        self.assertEqual( mr.pass_count, 1 )
+
+    def test_120_nested(self):
+        r = create_resolver()
+        mr = r.resolve( '${parent_${child}} and ${four}' )
+        self.assertEqual( mr.err_msg, None )
+        self.assertEqual( mr.result, 'duane and (2*(1+1))' )
+        # four -> good_two -> one
+        self.assertEqual( mr.pass_count, 3 )
+
+    def test_130_not_macros(self):
+        r = create_resolver()
+        for txt in ( '$dog', '${}', '${a b}', '}${dog}}', '${bad_macro}', '$${dog}' ):
+            mr = r.resolve( txt )
+            self.assertEqual( mr.err_msg, None )
+        self.assertEqual( r.resolve( '${a b}' ).result, '${a b}' )
+        self.assertEqual( r.resolve( '}${dog}}' ).result, '}Dolly}' )
+        self.assertEqual( r.resolve( '${bad_macro}' ).result, '${bad_macro' )
+        self.assertEqual( r.resolve( '$${dog}' ).result, '$Dolly' )
+        self.assertEqual( r.resolve( 'Borked ${parent_${child}' ).result, 'Borked ${parent_Zack' )
+
+    def test_131_no_rescan(self):
+        # a value is not scanned again with the text after it
+        r = envmacros.MacroResolver( create_resolver().lookup.child() )
+        r.lookup.add( 'dollar', '$' )
+        r.lookup.add( 'brace', '{dog}' )
+        r.lookup.add( 'half', '${do' )
+        self.assertEqual( r.resolve( '${dollar}{dog}' ).result, '${dog}' )
+        self.assertEqual( r.resolve( '$${brace}' ).result, '${dog}' )
+        self.assertEqual( r.resolve( '${half}g}' ).result, '${dog}' )
+        # but a value with a whole reference is expanded
+        r.lookup.add( 'name', 'dog' )
+        self.assertEqual( r.resolve( '${${name}}' ).result, 'Dolly' )
+
+    def test_140_errors(self):
+        r = create_resolver()
+        mr = r.resolve( 'x ${ref_undef} y' )
+        self.assertEqual( mr.result, None )
+        self.assertEqual( mr.err_msg, 'Undefined: undefined_thing' )
+        mr = r.resolve( '${A}' )
+        self.assertEqual( mr.result, None )
+        self.assertEqual( mr.err_msg, 'Too many passes' )
+        # with several errors, the last one in the text
+        self.assertEqual( r.resolve( 'bc${x_undef}d${y_undef}' ).err_msg, 'Undefined: y_undef' )
+        self.assertEqual( r.resolve( '${A}${x_undef}' ).err_msg, 'Undefined: x_undef' )
+        self.assertEqual( r.resolve( '${x_undef}${A}' ).err_msg, 'Too many passes' )
+        self.assertEqual( r.resolve( '${join(${x_undef},${y_undef})}' ).err_msg, 'Undefined: y_undef' )
+
+    def test_150_compile(self):
+        r = create_resolver()
+        t = r.compile( 'Hello ${parent_${child}} and ${dog}' )
+        self.assertTrue( t is r.compile( 'Hello ${parent_${child}} and ${dog}' ) )
+        with self.assertRaises( AttributeError ):
+            t.source = 'x'
+        mr = t.render( r.lookup )
+        self.assertEqual( mr.result, 'Hello duane and Dolly' )
+
+        other = envmacros.MacroLookup()
+        other.add( 'child', 'Zack' )
+        other.add( 'parent_Zack', 'Mom' )
+        results = t.render_many( [ r.lookup, other ] )
+        self.assertEqual( results[0].result, 'Hello duane and Dolly' )
+        self.assertEqual( results[1].result, None )
+        self.assertEqual( results[1].err_msg, 'Undefined: dog' )
+        other.add( 'dog', 'Rex' )
+        self.assertEqual( t.render( other ).result, 'Hello Mom and Rex' )
+
+        mr = r.compile( '${A}' ).render( r.lookup )
+        self.assertEqual( mr.err_msg, 'Too many passes' )
+
+    def test_160_cache(self):
+        lookup = envmacros.MacroLookup( cache = True )
+        r = envmacros.MacroResolver( lookup )
+        lookup.add( "one", "1" )
+        lookup.add( "good_two", "(1+${one})" )
+        lookup.add( "four", "(2*${good_two})" )
+        lookup.add( "child", "Zack" )
+        lookup.add( "parent_Zack", "${four}" )
+        lookup.add( "parent_Mia", "Ann" )
+        lookup.add( "who", "${parent_${child}}" )
+        lookup.add( "when", "${NOW}" )
+        lookup.add( "dog", "Dolly" )
+
+        self.assertEqual( r.resolve( '${four}' ).result, '(2*(1+1))' )
+        self.assertEqual( lookup.cache['four'][0], '(2*(1+1))' )
+        self.assertTrue( 'good_two' in lookup.cache )
+        mr = r.resolve( '${four}' )
+        self.assertEqual( mr.result, '(2*(1+1))' )
+        self.assertEqual( mr.pass_count, 3 )
+
+        # only dependents are forgotten
+        self.assertEqual( r.resolve( '${who}' ).result, '(2*(1+1))' )
+        lookup.add( 'dog', 'Rex' )
+        self.assertTrue( 'who' in lookup.cache )
+        lookup.add( 'one', '5' )
+        self.assertFalse( 'four' in lookup.cache )
+        self.assertFalse( 'who' in lookup.cache )
+        self.assertEqual( r.resolve( '${who}' ).result, '(2*(1+5))' )
+        lookup.add( 'child', 'Mia' )
+        self.assertEqual( r.resolve( '${who}' ).result, 'Ann' )
+
+        # volatile values are never cached
+        self.assertNotEqual( r.resolve( '${when}' ).result, None )
+        self.assertFalse( 'when' in lookup.cache )
+
+        # the cache does not hide recursion limits
+        result = envmacros.MacroResult()
+        result.pass_max = 2
+        self.assertTrue( 'four' in lookup.cache )
+        mr = r.resolve( '${four}', result )
+        self.assertEqual( mr.err_msg, 'Too many passes' )
+
+    def test_170_trace(self):
+        r = create_resolver()
+        off = envmacros.MacroResult( envmacros.MacroResult.TRACE_OFF )
+        mr = r.resolve( '${four} ${ref_undef}', off )
+        self.assertEqual( mr.err_msg, 'Undefined: undefined_thing' )
+        self.assertEqual( mr.steps, [] )
+        self.assertEqual( mr._steps, None )
+
+        # the default only records errors
+        mr = r.resolve( '${four}' )
+        self.assertEqual( mr.steps, [] )
+        mr = r.resolve( '${four} ${ref_undef}' )
+        self.assertEqual( mr.steps, [ 'Undefined: undefined_thing', 'in: ref_undef' ] )
+
+        r.trace = envmacros.MacroResult.TRACE_FULL
+        mr = r.resolve( '${four} 100%' )
+        self.assertEqual( mr.steps[0], 'start: ${four} 100%' )
+        self.assertTrue( 'one -> 1' in mr.steps )
+        self.assertEqual( mr.steps[-1], 'New: (2*(1+1)) 100%' )
+
     def eval_xx( self, str_expr ):
         self.flush()
         my_print("EVAL: %s" % str_expr)
@@ -310,3 +453,1004 @@ class MyTest( TestCase ):
         lookup = envmacros.MacroLookup()
         with self.assertRaises( envmacros.MacroDuplicate ):
             envmacros.read_text_varfile( fn, lookup )
+
+    def test_260_illegal(self):
+        r = create_eval()
+        for txt, msg in ( ( 'dog',              'Illegal: dog' ),
+                          ( 'evil(1)',          'Illegal: evil(' ),
+                          ( 'math.cos(0)',      'Illegal: math.cos(' ),
+                          ( '"abc"',            'Illegal: "abc"' ),
+                          ( '__import__("os")', 'Illegal: __import__(' ) ):
+            mr = r.eval( txt )
+            self.assertEqual( mr.result, None )
+            self.assertEqual( mr.err_msg, msg )
+        mr = r.eval( '3 * - / 4' )
+        self.assertTrue( mr.err_msg.startswith( 'Syntax Error:' ) )
+
+    def test_270_eval_cache(self):
+        r = create_eval()
+        cache = envmacros.expressions._compile_expression
+        self.assertEqual( r.eval( "(${one}<<(2*${four}))" ).result, 0x100 )
+        hits = cache.cache_info().hits
+        self.assertEqual( r.eval( "(${one}<<(2*${four}))" ).result, 0x100 )
+        self.assertEqual( cache.cache_info().hits, hits + 1 )
+        # functions with more than one parameter
+        self.eval_good( 4, "gcd(12, 8)" )
+
+    def test_280_ast_backend(self):
+        p = create_eval()
+        a = envmacros.ExpressionEvaluator( p.resolver, backend = 'ast' )
+        for txt in ( "1 + 1 + ${one} + 1", "2 / (${good_two})", "2 * ${should_have_parens}",
+                     "False !=  True", "cos(0)", "not not 7", "True and not False",
+                     "0 or 5", "1 and 0", "1 < 2 < 3", "3 > 2 > 2", "gcd(12, 8)",
+                     "((0x0100 & (${one}<<(2*${four}))) != 0) == True",
+                     "-7 // 2", "-7 % 3", "2 ** -1", "~5 ^ 3 | 8", "(-2) ** 3",
+                     "dog", "evil(1)", "1/0", "3 * - / 4" ):
+            want = p.eval( txt )
+            got  = a.eval( txt )
+            self.assertEqual( got.result, want.result, txt )
+            self.assertEqual( type(got.result), type(want.result), txt )
+            self.assertEqual( got.err_msg, want.err_msg, txt )
+
+    def test_281_ast_limits(self):
+        a = envmacros.ExpressionEvaluator( create_resolver(), backend = 'ast' )
+        for txt in ( "9**9**9", "1 << 100000", "(2**4000) * (2**4000)", "factorial(100000)",
+                     "(1==1) << 100000", "(not 0) << 100000000", "3**4000", "(-3)**4000" ):
+            mr = a.eval( txt )
+            self.assertEqual( mr.result, None, txt )
+            self.assertTrue( mr.err_msg.startswith( 'Too large:' ), mr.err_msg )
+        self.assertEqual( a.eval( "1 ** 100000" ).result, 1 )
+        self.assertEqual( a.eval( "(1==1) << 4000" ).result, 1 << 4000 )
+        self.assertEqual( a.eval( "3**2500" ).result, 3**2500 )
+        mr = a.eval( "-" * 150 + "1" )
+        self.assertTrue( mr.err_msg.startswith( 'Too deep:' ), mr.err_msg )
+
+    def test_290_resolve_many(self):
+        r = create_resolver()
+        calls = []
+        class CountingLookup( envmacros.MacroLookup ):
+            def lookup( self, result, name ):
+                calls.append( name )
+                return envmacros.MacroLookup.lookup( self, result, name )
+        counting = CountingLookup()
+        counting.entries = r.lookup.entries
+        r = envmacros.MacroResolver( counting )
+
+        errors = dict()
+        texts = ( '${four}', 'plain', '${dog} ${four}', '${ref_undef}', '${A}', '${dog}' )
+        out = r.resolve_many( iter( texts ), errors )
+        self.assertTrue( hasattr( out, '__next__' ) )
+        self.assertEqual( list( out ), [ '(2*(1+1))', 'plain', 'Dolly (2*(1+1))', None, None, 'Dolly' ] )
+        self.assertEqual( errors, { 3 : 'Undefined: undefined_thing', 4 : 'Too many passes' } )
+        self.assertEqual( calls.count( 'four' ), 1 )
+        self.assertEqual( calls.count( 'one' ), 1 )
+        self.assertEqual( calls.count( 'dog' ), 1 )
+
+    def test_291_eval_many(self):
+        e = create_eval()
+        errors = dict()
+        out = list( e.eval_many( [ '${one}<<(2*${four})', 'dog', '2 * ${good_two}' ], errors ) )
+        self.assertEqual( out, [ 0x100, None, 4 ] )
+        self.assertEqual( errors, { 1 : 'Illegal: dog' } )
+
+    def test_300_render_stream(self):
+        import io
+        r = create_resolver()
+        text = ( 'Hello ${parent_${child}}!\n' * 50 ) + ( '${dog}$ ${a b} }' * 40 ) + '\nend ${four}'
+        want = r.resolve( text ).result
+        for chunk_size in ( 1, 2, 3, 7, 64, 100000 ):
+            out = io.StringIO()
+            mr = r.render_stream( io.StringIO( text ), out, chunk_size )
+            self.assertEqual( mr.err_msg, None )
+            self.assertEqual( out.getvalue(), want )
+            self.assertEqual( mr.result, len( want ) )
+
+        # binary in and out
+        out = io.BytesIO()
+        mr = r.render_stream( io.BytesIO( 'café ${dog}é'.encode( 'utf-8' ) ), out, 1 )
+        self.assertEqual( out.getvalue().decode( 'utf-8' ), 'café Dollyé' )
+
+    def test_301_render_stream_error(self):
+        import io
+        r = create_resolver()
+        out = io.StringIO()
+        mr = r.render_stream( io.StringIO( 'one\ntwo ${dog}\nxx ${four} ${ref_undef} ${dog}\n' ), out, 4 )
+        self.assertEqual( mr.result, None )
+        self.assertEqual( mr.err_msg, 'line 3, column 12: Undefined: undefined_thing' )
+        self.assertEqual( mr.where, '<stream>:3:12' )
+        # with two errors, where the reported one is
+        mr = r.render_stream( io.StringIO( 'ok ${dog}\n${x_undef} a\nb ${y_undef}\n' ), io.StringIO() )
+        self.assertEqual( mr.err_msg, 'line 3, column 3: Undefined: y_undef' )
+
+    def test_302_render_mmap(self):
+        import io, mmap, tempfile
+        r = create_resolver()
+        with tempfile.TemporaryFile() as f:
+            f.write( b'${dog} and ${parent_${child}}\n' * 1000 )
+            f.flush()
+            with mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ ) as m:
+                out = io.StringIO()
+                mr = r.render_stream( m, out, 1000 )
+        self.assertEqual( mr.err_msg, None )
+        self.assertEqual( out.getvalue(), 'Dolly and duane\n' * 1000 )
+
+    def test_303_render_stream_memory(self):
+        import io
+        import envmacros.envmacros as em
+        r = create_resolver()
+        def size( chunks ):
+            em._compile_cached.cache_clear()
+            out = io.StringIO()
+            text = ''.join( '${dog} chunk %05d\n' % x for x in range( chunks * 10 ) )
+            mr = r.render_stream( io.StringIO( text ), out, 180 )
+            self.assertEqual( mr.err_msg, None )
+            return em._compile_cached.cache_info().currsize
+        # the chunks are not kept in the compile cache
+        self.assertEqual( size( 10 ), size( 200 ) )
+
+        # the stream memo does not outlive the stream
+        result = envmacros.MacroResult()
+        r.render_stream( io.StringIO( '${dog}' ), io.StringIO(), result = result )
+        self.assertEqual( result.memo, None )
+        r.lookup.add( 'dog', 'CHANGED' )
+        self.assertEqual( r.resolve( '${dog}', result.reset() ).result, 'CHANGED' )
+
+    def test_350_env_not_duplicate( self ):
+        fn = os.path.join( os.path.dirname( __file__ ), 'test_var_file_good.txt' )
+        os.environ['myvar'] = 'from the environment'
+        try:
+            lookup = envmacros.MacroLookup( allow_env = True )
+            envmacros.read_text_varfile( fn, lookup )
+        finally:
+            del os.environ['myvar']
+        self.assertEqual( lookup.entries['myvar'][0], 'SomeValue' )
+        self.assertEqual( lookup.where( 'myvar' ), fn + ':6' )
+
+        # but things already in the lookup are
+        with self.assertRaises( envmacros.MacroDuplicate ) as e:
+            envmacros.read_text_varfile( fn, lookup )
+        self.assertEqual( str( e.exception ), '%s:6: Duplicate myvar, previous: %s:6' % (fn, fn) )
+
+    def test_360_big_varfile( self ):
+        # how fast: see the varfile_big workload in envmacros.bench
+        import tempfile
+        n = 1000
+        with tempfile.NamedTemporaryFile( 'w', suffix = '.txt', delete = False ) as f:
+            fn = f.name
+            f.write( "# a big file\n" )
+            for x in range( n ):
+                f.write( "var_%d = value ${var_%d} %d\n" % (x, x // 2, x) )
+        try:
+            lookup = envmacros.MacroLookup()
+            envmacros.read_text_varfile( fn, lookup )
+        finally:
+            os.remove( fn )
+        self.assertEqual( len( lookup.entries ), n )
+        self.assertEqual( lookup.entries['var_999'][0], 'value ${var_499} 999' )
+        self.assertEqual( lookup.where( 'var_999' ), '%s:%d' % (fn, n + 1) )
+
+    def test_370_varfile_cache( self ):
+        import tempfile, shutil, marshal
+        import envmacros.varfile_cache as varfile_cache
+        d = tempfile.mkdtemp()
+        try:
+            fn = os.path.join( d, 'vars.txt' )
+            with open( fn, 'w' ) as f:
+                f.write( "one = 1\ntwo = (${one}+${one})\n" )
+            cname = os.path.join( d, '.vars.txt.envcache' )
+
+            lookup = envmacros.MacroLookup()
+            envmacros.read_text_varfile( fn, lookup, cache = True )
+            self.assertTrue( os.path.exists( cname ) )
+            self.assertEqual( entry( lookup, 'two' ), ( '(${one}+${one})', fn + ':2' ) )
+
+            # a warm start does not parse
+            import envmacros.text_varfile as tv
+            parse = tv._parse_text_varfile
+            tv._parse_text_varfile = None
+            try:
+                lookup = envmacros.MacroLookup()
+                envmacros.read_text_varfile( fn, lookup, cache = True )
+            finally:
+                tv._parse_text_varfile = parse
+            self.assertEqual( entry( lookup, 'one' ), ( '1', fn + ':1' ) )
+
+            # a changed file is parsed again
+            with open( fn, 'w' ) as f:
+                f.write( "one = 11\n" )
+            lookup = envmacros.MacroLookup()
+            envmacros.read_text_varfile( fn, lookup, cache = True )
+            self.assertEqual( list( lookup.entries ), [ 'one' ] )
+            self.assertEqual( entry( lookup, 'one' ), ( '11', fn + ':1' ) )
+
+            # so is one with a corrupt cache, that is written again
+            for blob in (varfile_cache._MAGIC + b'garbage', varfile_cache._MAGIC + marshal.dumps( 1 )):
+                with open( cname, 'wb' ) as f:
+                    f.write( blob )
+                lookup = envmacros.MacroLookup()
+                envmacros.read_text_varfile( fn, lookup, cache = True )
+                self.assertEqual( list( lookup.entries ), [ 'one' ] )
+                self.assertEqual( entry( lookup, 'one' ), ( '11', fn + ':1' ) )
+                with open( cname, 'rb' ) as f:
+                    self.assertNotEqual( f.read(), blob )
+
+            # a cache directory
+            cdir = os.path.join( d, 'cache' )
+            os.mkdir( cdir )
+            lookup = envmacros.MacroLookup()
+            envmacros.read_text_varfile( fn, lookup, cache = cdir )
+            self.assertEqual( len( os.listdir( cdir ) ), 1 )
+            self.assertEqual( list( lookup.entries ), [ 'one' ] )
+            self.assertEqual( entry( lookup, 'one' ), ( '11', fn + ':1' ) )
+        finally:
+            shutil.rmtree( d )
+
+    def test_380_varfiles( self ):
+        import tempfile, shutil
+        d = tempfile.mkdtemp()
+        try:
+            names = []
+            for n in range( 8 ):
+                fn = os.path.join( d, 'vars%d.txt' % n )
+                with open( fn, 'w' ) as f:
+                    for x in range( 500 ):
+                        f.write( "v%d_%d = value %d\n" % (n, x, x) )
+                names.append( fn )
+            want = envmacros.MacroLookup()
+            for fn in names:
+                envmacros.read_text_varfile( fn, want )
+
+            # the same as one at a time, how it scales: see envmacros.bench
+            for processes in ( False, True ):
+                lookup = envmacros.MacroLookup()
+                envmacros.read_text_varfiles( names, lookup, 4, processes = processes )
+                self.assertEqual( lookup.entries, want.entries )
+
+            # duplicates across files are reported like read_text_varfile()
+            dup = os.path.join( d, 'dup.txt' )
+            with open( dup, 'w' ) as f:
+                f.write( "# dup\nv3_17 = again\n" )
+            with self.assertRaises( envmacros.MacroDuplicate ) as e:
+                envmacros.read_text_varfiles( names + [ dup ], envmacros.MacroLookup(), 4 )
+            self.assertEqual( str( e.exception ),
+                              "%s:2: Duplicate v3_17, previous: %s:18" % (dup, names[3]) )
+        finally:
+            shutil.rmtree( d )
+
+    def test_400_scopes( self ):
+        base = envmacros.MacroLookup()
+        for x in range( 1000 ):
+            base.add( 'v%d' % x, str( x ) )
+        base.add( 'color', 'blue' )
+        base.add( 'msg', '${color} ${v7}' )
+
+        scope = base.child()
+        self.assertEqual( len( scope.entries ), 0 )
+        scope.add( 'color', 'red' )
+        r = envmacros.MacroResolver( scope )
+        self.assertEqual( r.resolve( '${msg}' ).result, 'red 7' )
+        self.assertEqual( envmacros.MacroResolver( base ).resolve( '${msg}' ).result, 'blue 7' )
+
+        # deeper scopes, and changes to a base are seen
+        deep = scope
+        for x in range( 10 ):
+            deep = deep.child()
+        deep.add( 'v7', 'seven' )
+        r = envmacros.MacroResolver( deep )
+        self.assertEqual( r.resolve( '${msg} ${v999}' ).result, 'red seven 999' )
+        base.add( 'v999', 'nine' )
+        scope.add( 'color', 'green' )
+        self.assertEqual( r.resolve( '${msg} ${v999}' ).result, 'green seven nine' )
+        self.assertEqual( r.resolve( '${nope}' ).err_msg, 'Undefined: nope' )
+        base.add( 'nope', 'yes' )
+        self.assertEqual( r.resolve( '${nope}' ).result, 'yes' )
+        # the bases do not see the child
+        self.assertEqual( envmacros.MacroResolver( scope ).resolve( '${v7}' ).result, '7' )
+
+    def test_410_freeze( self ):
+        import threading
+        base = create_resolver().lookup
+        scope = base.child()
+        scope.add( 'dog', 'Rex' )
+        snap = scope.freeze()
+        with self.assertRaises( envmacros.MacroError ):
+            snap.add( 'dog', 'Fido' )
+        with self.assertRaises( TypeError ):
+            snap.entries['dog'] = ( 'Fido', None )
+        # later changes are not seen
+        base.add( 'cat', 'Tom' )
+        scope.add( 'dog', 'Spot' )
+
+        r = envmacros.MacroResolver( snap )
+        e = envmacros.ExpressionEvaluator( r )
+        self.assertEqual( snap.parent, None )
+        errors = []
+        def work():
+            for x in range( 200 ):
+                if r.resolve( '${dog} ${parent_${child}} ${four}' ).result != 'Rex duane (2*(1+1))':
+                    errors.append( x )
+                if e.eval( '${one}<<(2*${four})' ).result != 0x100:
+                    errors.append( x )
+                if r.resolve( '${cat}' ).err_msg != 'Undefined: cat':
+                    errors.append( x )
+        threads = [ threading.Thread( target = work ) for x in range( 8 ) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual( errors, [] )
+
+        # copy on write
+        thawed = snap.thaw()
+        thawed.add( 'dog', 'Fido' )
+        self.assertEqual( envmacros.MacroResolver( thawed ).resolve( '${dog} ${child}' ).result, 'Fido Zack' )
+        self.assertEqual( r.resolve( '${dog}' ).result, 'Rex' )
+
+    def test_420_freeze_env( self ):
+        os.environ['ENVMACROS_TEST_X'] = 'before'
+        try:
+            lookup = envmacros.MacroLookup()
+            live = envmacros.MacroResolver( lookup.freeze() )
+            captured = envmacros.MacroResolver( lookup.freeze( capture_env = True ) )
+            os.environ['ENVMACROS_TEST_X'] = 'after'
+            self.assertEqual( live.resolve( '${ENVMACROS_TEST_X}' ).result, 'after' )
+            self.assertEqual( captured.resolve( '${ENVMACROS_TEST_X}' ).result, 'before' )
+        finally:
+            del os.environ['ENVMACROS_TEST_X']
+
+    def test_430_env_modes( self ):
+        os.environ['ENVMACROS_TEST_X'] = 'one'
+        os.environ['OTHER_ENVMACROS_TEST'] = 'other'
+        try:
+            live = envmacros.MacroLookup()
+            snap = envmacros.MacroLookup( env_mode = envmacros.MacroLookup.ENV_SNAPSHOT )
+            pre  = envmacros.MacroLookup( env_mode = 'prefix', env_prefix = 'ENVMACROS_' )
+            scope = snap.child()
+            os.environ['ENVMACROS_TEST_X'] = 'two'
+            text = '${ENVMACROS_TEST_X}'
+            self.assertEqual( envmacros.MacroResolver( live ).resolve( text ).result, 'two' )
+            self.assertEqual( envmacros.MacroResolver( snap ).resolve( text ).result, 'one' )
+            self.assertEqual( envmacros.MacroResolver( scope ).resolve( text ).result, 'one' )
+            self.assertEqual( envmacros.MacroResolver( pre ).resolve( text ).result, 'one' )
+            mr = envmacros.MacroResolver( pre ).resolve( '${OTHER_ENVMACROS_TEST}' )
+            self.assertEqual( mr.err_msg, 'Undefined: OTHER_ENVMACROS_TEST' )
+            snap.refresh_env()
+            pre.refresh_env()
+            self.assertEqual( envmacros.MacroResolver( snap ).resolve( text ).result, 'two' )
+            self.assertEqual( envmacros.MacroResolver( scope ).resolve( text ).result, 'two' )
+            self.assertEqual( envmacros.MacroResolver( pre ).resolve( text ).result, 'two' )
+        finally:
+            del os.environ['ENVMACROS_TEST_X']
+            del os.environ['OTHER_ENVMACROS_TEST']
+
+    def test_440_dynamic( self ):
+        calls = []
+        class MyLookup( envmacros.MacroLookup ):
+            def macro_TICK( self, name, result ):
+                calls.append( name )
+                return str( len( calls ) )
+            @envmacros.dynamic_macro( envmacros.DYNAMIC_TTL, ttl = 1000 )
+            def macro_SLOW( self, name, result ):
+                calls.append( name )
+                return 'slow'
+        lookup = MyLookup()
+        self.assertEqual( sorted( lookup._dynamic ), [ 'GETCWD', 'NOW', 'SLOW', 'TICK' ] )
+        lookup.add( 'tick2', '${TICK}' )
+        r = envmacros.MacroResolver( lookup )
+
+        # volatile: every time, even in a batch
+        self.assertEqual( r.resolve( '${TICK} ${TICK}' ).result, '1 2' )
+        self.assertEqual( list( r.resolve_many( [ '${TICK}', '${tick2} ${tick2}' ] ) ), [ '3', '4 5' ] )
+        # ttl: cached across resolves
+        self.assertEqual( r.resolve( '${SLOW} ${SLOW}' ).result, 'slow slow' )
+        self.assertEqual( r.resolve( '${SLOW}' ).result, 'slow' )
+        self.assertEqual( calls.count( 'SLOW' ), 1 )
+
+        # per resolve
+        now = []
+        def counter( name, result ):
+            now.append( name )
+            return str( len( now ) )
+        lookup.register_dynamic( 'COUNT', counter, envmacros.DYNAMIC_PER_RESOLVE )
+        self.assertEqual( r.resolve( '${COUNT} ${COUNT}' ).result, '1 1' )
+        self.assertEqual( r.resolve( '${COUNT}' ).result, '2' )
+
+        def broken( name, result ):
+            raise ValueError( 'nope' )
+        lookup.register_dynamic( 'BROKEN', broken )
+        self.assertEqual( r.resolve( '${BROKEN}' ).err_msg, 'Exception: broken() -> nope' )
+        self.assertEqual( r.resolve( '${GETCWD}' ).result, os.getcwd() )
+
+    def test_441_freeze_dynamic( self ):
+        lookup = envmacros.MacroLookup( allow_env = False )
+        snap = lookup.freeze()
+        lookup.register_dynamic( 'LATE', lambda name, result: 'late' )
+        self.assertEqual( envmacros.MacroResolver( lookup ).resolve( '${LATE}' ).result, 'late' )
+        # the snapshot does not see it
+        x = envmacros.MacroResolver( snap ).resolve( '${LATE}' )
+        self.assertEqual( x.err_msg, 'Undefined: LATE' )
+
+        # nor does a child change its base
+        lookup.register_dynamic( 'HOST', lambda name, result: 'base-host', envmacros.DYNAMIC_TTL, 100 )
+        self.assertEqual( envmacros.MacroResolver( lookup ).resolve( '${HOST}' ).result, 'base-host' )
+        child = lookup.child()
+        child.register_dynamic( 'HOST', lambda name, result: 'child-host', envmacros.DYNAMIC_TTL, 100 )
+        self.assertEqual( envmacros.MacroResolver( child ).resolve( '${HOST}' ).result, 'child-host' )
+        self.assertEqual( envmacros.MacroResolver( lookup ).resolve( '${HOST}' ).result, 'base-host' )
+
+    def test_500_bench( self ):
+        import io, json, tempfile, contextlib
+        from envmacros import bench
+        fd, fn = tempfile.mkstemp( suffix = '.json' )
+        os.close( fd )
+        try:
+            out = io.StringIO()
+            with contextlib.redirect_stdout( out ):
+                self.assertEqual( bench.main( [ '--quick', '--save', fn ] ), 0 )
+            my_print( out.getvalue() )
+            with open( fn ) as f:
+                saved = json.load( f )
+            names = [ name for name, setup in bench.workloads() ]
+            self.assertEqual( sorted( saved['results'] ), sorted( names ) )
+            for r in saved['results'].values():
+                self.assertTrue( r['ops_per_sec'] > 0 )
+                self.assertTrue( r['p99_us'] >= r['p50_us'] )
+
+            # pretend the baseline was much faster
+            for r in saved['results'].values():
+                r['ops_per_sec'] *= 1000
+            with open( fn, 'w' ) as f:
+                json.dump( saved, f )
+            out = io.StringIO()
+            with contextlib.redirect_stdout( out ):
+                self.assertEqual( bench.main( [ '--quick', '--only', 'resolve_deep', '--compare', fn ] ), 1 )
+            self.assertTrue( 'REGRESSION: resolve_deep' in out.getvalue() )
+        finally:
+            os.remove( fn )
+
+    def test_510_stats( self ):
+        r = create_resolver()
+        self.assertEqual( r.stats(), None )
+        samples = []
+        calls = []
+        stats = r.enable_stats( envmacros.MacroStats( samples.append, 2 ) )
+        stats.add_callback( lambda name, source, seconds: calls.append( (name, source) ) )
+        os.environ['ENVMACROS_TEST_X'] = 'x'
+        try:
+            r.resolve( '${four} ${dog}' )
+            r.resolve( '${dog} ${ENVMACROS_TEST_X} ${GETCWD}' )
+            r.resolve( '${nope}' )
+        finally:
+            del os.environ['ENVMACROS_TEST_X']
+        e = envmacros.ExpressionEvaluator( r )
+        e.eval( '${one} + 1' )
+
+        snap = r.stats()
+        self.assertEqual( snap['lookups']['dog'], 2 )
+        self.assertEqual( snap['lookups']['one'], 2 )
+        self.assertEqual( snap['sources'], { 'entries' : 6, 'env' : 1, 'dynamic' : 1,
+                                             'undefined' : 1, 'cached' : 0, 'memo' : 0 } )
+        self.assertEqual( snap['depths'], { 3 : 1, 1 : 3 } )
+        self.assertEqual( snap['resolves'], 4 )
+        self.assertEqual( snap['evals'], 1 )
+        self.assertTrue( snap['time_lookup'] > 0 )
+        self.assertTrue( ('GETCWD', 'dynamic') in calls )
+        self.assertEqual( len( samples ), 2 )
+
+        r.disable_stats()
+        r.resolve( '${dog}' )
+        self.assertEqual( stats.lookups['dog'], 2 )
+
+    def test_520_functions( self ):
+        r = create_resolver()
+        r.lookup.add( 'path', '/usr/local/bin/tool' )
+        r.lookup.add( 'csv', 'a,b' )
+        r.lookup.add( 'dir', '${dirname(${path})}' )
+        self.assertEqual( r.resolve( '${dirname(${path})}' ).result, '/usr/local/bin' )
+        self.assertEqual( r.resolve( '${basename(${dir})}' ).result, 'bin' )
+        self.assertEqual( r.resolve( '${os.path.dirname(${dir})}' ).result, '/usr/local' )
+        self.assertEqual( r.resolve( '${upper(${basename(${path})})}' ).result, 'TOOL' )
+        self.assertEqual( r.resolve( '${join(${dir}, x, ${dog})}' ).result, '/usr/local/bin/x/Dolly' )
+        # commas from macro values do not split arguments
+        self.assertEqual( r.resolve( '${upper(${csv})}' ).result, 'A,B' )
+        # a function result can make a macro name
+        self.assertEqual( r.resolve( '${parent_${basename(x/Zack)}}' ).result, 'duane' )
+
+        os.environ['ENVMACROS_TEST_F'] = 'yes'
+        try:
+            self.assertEqual( r.resolve( '${env(ENVMACROS_TEST_F)}' ).result, 'yes' )
+        finally:
+            del os.environ['ENVMACROS_TEST_F']
+        self.assertEqual( r.resolve( '${env(ENVMACROS_TEST_F,no)}' ).result, 'no' )
+
+        x = r.resolve( '${nosuch(${dog})}' )
+        self.assertEqual( x.result, None )
+        self.assertEqual( x.err_msg, 'Unknown function: nosuch()' )
+        # the old resolver left these as they were
+        x = r.resolve( 'a ${foo(bar)} b' )
+        self.assertEqual( x.result, None )
+        self.assertEqual( x.err_msg, 'Unknown function: foo()' )
+        x = r.resolve( '${dirname(${undefined_thing})}' )
+        self.assertEqual( x.err_msg, 'Undefined: undefined_thing' )
+        x = r.resolve( '${upper(a,b)}' )
+        self.assertTrue( x.err_msg.startswith( 'Exception: upper() -> ' ) )
+
+        # custom functions, pure ones are cached
+        calls = []
+        def twice( s ):
+            calls.append( s )
+            return s + s
+        envmacros.register_function( 'twice', twice, pure = True )
+        try:
+            self.assertEqual( r.resolve( '${twice(${dog})}' ).result, 'DollyDolly' )
+            self.assertEqual( r.resolve( '[${twice(${dog})}]' ).result, '[DollyDolly]' )
+            self.assertEqual( calls, ['Dolly'] )
+            envmacros.register_function( 'count', lambda *a: len(a) )
+            self.assertEqual( r.resolve( '${count(a,(b,c),d)}' ).result, '3' )
+        finally:
+            envmacros.unregister_function( 'twice' )
+            envmacros.unregister_function( 'count' )
+        self.assertEqual( r.resolve( '${twice(x)}' ).err_msg, 'Unknown function: twice()' )
+
+    def test_521_functions_cache( self ):
+        lookup = envmacros.MacroLookup( cache = True )
+        r = envmacros.MacroResolver( lookup )
+        lookup.add( 'path', '/a/b' )
+        lookup.add( 'dir', '${dirname(${path})}' )
+        lookup.add( 'home', '${env(ENVMACROS_TEST_G,none)}' )
+        self.assertEqual( r.resolve( '${dir}' ).result, '/a' )
+        lookup.add( 'path', '/c/d' )
+        self.assertEqual( r.resolve( '${dir}' ).result, '/c' )
+        # env() is not pure, so it is not cached
+        self.assertEqual( r.resolve( '${home}' ).result, 'none' )
+        os.environ['ENVMACROS_TEST_G'] = 'set'
+        try:
+            self.assertEqual( r.resolve( '${home}' ).result, 'set' )
+        finally:
+            del os.environ['ENVMACROS_TEST_G']
+
+    def test_522_functions_env( self ):
+        # env() sees the same environment as ${NAME}
+        os.environ['ENVMACROS_TEST_H'] = 'one'
+        os.environ['OTHER_ENVMACROS_TEST'] = 'other'
+        try:
+            text = '${env(ENVMACROS_TEST_H,none)} ${env(OTHER_ENVMACROS_TEST,none)}'
+            none = envmacros.MacroLookup( allow_env = False )
+            pre  = envmacros.MacroLookup( env_mode = 'prefix', env_prefix = 'ENVMACROS_' )
+            live = envmacros.MacroLookup()
+            captured = live.freeze( capture_env = True )
+            os.environ['ENVMACROS_TEST_H'] = 'two'
+            self.assertEqual( envmacros.MacroResolver( none ).resolve( text ).result, 'none none' )
+            self.assertEqual( envmacros.MacroResolver( pre ).resolve( text ).result, 'one none' )
+            self.assertEqual( envmacros.MacroResolver( live ).resolve( text ).result, 'two other' )
+            self.assertEqual( envmacros.MacroResolver( captured ).resolve( text ).result, 'one other' )
+        finally:
+            del os.environ['ENVMACROS_TEST_H']
+            del os.environ['OTHER_ENVMACROS_TEST']
+
+        # custom functions can use the lookup too
+        def raw( lookup, name ):
+            return lookup.lookup( envmacros.MacroResult(), name ) or '-'
+        envmacros.register_function( 'raw', raw, lookup = True )
+        try:
+            r = create_resolver()
+            self.assertEqual( r.resolve( '${raw(Foo)} ${raw(undefined_thing)}' ).result, 'Bar -' )
+        finally:
+            envmacros.unregister_function( 'raw' )
+        with self.assertRaises( envmacros.MacroError ):
+            envmacros.register_function( 'raw', raw, pure = True, lookup = True )
+
+    def test_530_compact_results( self ):
+        r = create_resolver()
+        result = envmacros.MacroResult()
+        with self.assertRaises( AttributeError ):
+            result.not_a_slot = 1
+        # one result reused for many resolves
+        for x in range( 3 ):
+            self.assertTrue( r.resolve( '${Foo}', result.reset() ) is result )
+            self.assertEqual( result.result, 'Bar' )
+        r.resolve( '${undefined_thing}', result.reset() )
+        self.assertEqual( result.steps, [ 'Undefined: undefined_thing' ] )
+        r.resolve( '${dog}', result.reset() )
+        self.assertEqual( result.steps, [] )
+
+        # where is kept compact and made into text when asked for
+        fn = os.path.join( os.path.dirname( __file__ ), 'test_var_file_good.txt' )
+        lookup = envmacros.MacroLookup( allow_env = False )
+        envmacros.read_text_varfile( fn, lookup )
+        self.assertTrue( isinstance( lookup.entries['myvar'][1], int ) )
+        x = envmacros.MacroResolver( lookup ).resolve( '${myvar}' )
+        self.assertEqual( x.where, fn + ':6' )
+        lookup.add( 'other', 'x', 'here' )
+        self.assertEqual( lookup.where( 'other' ), 'here' )
+        # a plain line number, like before
+        lookup.add( 'numbered', 'x', 12 )
+        self.assertEqual( lookup.where( 'numbered' ), 12 )
+        self.assertEqual( lookup.where( 'nope' ), None )
+
+    def test_540_async( self ):
+        import asyncio
+
+        class SecretLookup( envmacros.MacroLookup ):
+            # a stand in for a slow secrets daemon
+            def __init__( self ):
+                envmacros.MacroLookup.__init__( self, allow_env = False )
+                self.add( 'user', 'dolly' )
+                self.add( 'dsn', 'db://${user}:${PASSWORD}@${HOST}' )
+
+            async def macro_PASSWORD( self, name, result ):
+                return await daemon( name, 'secret' )
+
+            async def macro_HOST( self, name, result ):
+                return await daemon( name, 'dbhost' )
+
+        async def daemon( name, value ):
+            calls.append( name )
+            if together:
+                # [ started, event ]: wait until both were asked for,
+                # if they are fetched one after the other this times out
+                together[0] += 1
+                if together[0] == 2:
+                    together[1].set()
+                await asyncio.wait_for( together[1].wait(), 5 )
+            else:
+                await asyncio.sleep( 0 )
+            return value
+
+        calls = []
+        together = []
+        lookup = SecretLookup()
+        r = envmacros.MacroResolver( lookup )
+
+        # the sync path refuses async macros
+        x = r.resolve( '${dsn}' )
+        self.assertEqual( x.result, None )
+        self.assertTrue( 'aresolve' in x.err_msg )
+
+        # independent macros are fetched at the same time
+        async def both():
+            together[:] = [ 0, asyncio.Event() ]
+            try:
+                return await r.aresolve( '${dsn}' )
+            finally:
+                del together[:]
+        x = asyncio.run( both() )
+        self.assertEqual( x.err_msg, None )
+        self.assertEqual( x.result, 'db://dolly:secret@dbhost' )
+        self.assertEqual( sorted( calls ), [ 'HOST', 'PASSWORD' ] )
+
+        # the same lookup in flight is done once
+        calls.clear()
+        async def many():
+            return await asyncio.gather( *[ r.aresolve( '${PASSWORD}' ) for x in range( 10 ) ] )
+        results = asyncio.run( many() )
+        self.assertEqual( [ x.result for x in results ], [ 'secret' ] * 10 )
+        self.assertEqual( calls, [ 'PASSWORD' ] )
+
+        # a name that comes from an async macro
+        lookup.add( 'key_dbhost', 'found' )
+        x = asyncio.run( r.aresolve( '${key_${HOST}}' ) )
+        self.assertEqual( x.result, 'found' )
+
+        # errors
+        async def broken( name, result ):
+            raise ValueError( 'daemon down' )
+        lookup.register_dynamic( 'BROKEN', broken )
+        x = asyncio.run( r.aresolve( '${user} ${BROKEN}' ) )
+        self.assertEqual( x.result, None )
+        self.assertEqual( x.err_msg, 'Exception: broken() -> daemon down' )
+
+        # expressions
+        async def answer( name, result ):
+            return 21
+        lookup.register_dynamic( 'HALF', answer, envmacros.DYNAMIC_TTL, ttl = 60 )
+        e = envmacros.ExpressionEvaluator( r )
+        x = asyncio.run( e.aeval( '${HALF} * 2' ) )
+        self.assertEqual( x.result, 42 )
+        # cached for the ttl, so the sync path can use it too
+        self.assertEqual( e.eval( '${HALF} + 1' ).result, 22 )
+
+    def test_541_async_threads( self ):
+        # a snapshot shared by threads, each with its own event loop
+        import asyncio, threading
+        both = threading.Barrier( 2 )
+        async def secret( name, result ):
+            # both threads fetch at the same time
+            both.wait( 5 )
+            return 'secret'
+        lookup = envmacros.MacroLookup( allow_env = False )
+        lookup.register_dynamic( 'SECRET', secret )
+        r = envmacros.MacroResolver( lookup.freeze() )
+        results = []
+        def run():
+            x = asyncio.run( r.aresolve( '${SECRET}' ) )
+            results.append( (x.result, x.err_msg) )
+        threads = [ threading.Thread( target = run ) for x in range( 2 ) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual( results, [ ('secret', None) ] * 2 )
+
+    def test_550_validate( self ):
+        r = create_resolver()
+        lookup = r.lookup
+        lookup.add( 'self_ref', 'x${self_ref}', 'vars.txt:9' )
+        lookup.add( 'uses_cycle', '${A}' )
+        lookup.add( 'bad_func', '${nosuch(${dog})}' )
+        lookup.add( 'bad_name', '${a b}' )
+        lookup.add( 'computed', '${parent_${child}}' )
+        problems = lookup.validate()
+        found = sorted( (p.kind, p.name, p.message) for p in problems )
+        self.assertEqual( found, [
+            ('cycle',     'A',         'Cycle: A, B, C, D'),
+            ('cycle',     'B',         'Cycle: A, B, C, D'),
+            ('cycle',     'C',         'Cycle: A, B, C, D'),
+            ('cycle',     'D',         'Cycle: A, B, C, D'),
+            ('cycle',     'self_ref',  'Cycle: self_ref'),
+            ('malformed', 'bad_macro', 'Malformed: ${bad_macro'),
+            ('malformed', 'bad_name',  'Malformed: ${a b}'),
+            ('undefined', 'bad_func',  'Unknown function: nosuch()'),
+            ('undefined', 'ref_undef', 'Undefined: undefined_thing'),
+            ] )
+        self.assertEqual( [ p.where for p in problems if p.name == 'self_ref' ], [ 'vars.txt:9' ] )
+
+        # known cycles fail at once
+        x = r.resolve( '${uses_cycle}' )
+        self.assertEqual( x.err_msg, 'Too many passes' )
+        self.assertEqual( x.pass_count, 2 )
+        self.assertEqual( r.resolve( '${dog}' ).result, 'Dolly' )
+
+        # until something changes
+        lookup.add( 'D', 'end' )
+        self.assertEqual( r.resolve( '${uses_cycle}' ).result, 'end' )
+        self.assertEqual( [ p.name for p in lookup.validate() if p.kind == 'cycle' ], [ 'self_ref' ] )
+
+        # a change in a base is seen by a scope
+        lookup.add( 'D', '${A}' )
+        scope = lookup.child()
+        self.assertEqual( len( [ p for p in scope.validate() if p.kind == 'cycle' ] ), 5 )
+        self.assertEqual( envmacros.MacroResolver( scope ).resolve( '${A}' ).pass_count, 1 )
+        lookup.add( 'D', 'base' )
+        self.assertEqual( envmacros.MacroResolver( scope ).resolve( '${A}' ).result, 'base' )
+
+    def test_560_materialize( self ):
+        lookup = envmacros.MacroLookup( allow_env = False, cache = True )
+        lookup.add( 'root', '/opt' )
+        lookup.add( 'bin', '${root}/bin' )
+        lookup.add( 'lib', '${root}/lib' )
+        lookup.add( 'path', '${bin}:${lib}' )
+        lookup.add( 'when', '${NOW}' )
+        lookup.add( 'also_when', '${when}' )
+        calls = []
+        def counted( name, result ):
+            calls.append( name )
+            return 'counted'
+        lookup.register_dynamic( 'COUNTED', counted, envmacros.DYNAMIC_PER_RESOLVE )
+        lookup.add( 'c1', '${COUNTED}' )
+        lookup.add( 'c2', '[${c1}]' )
+        lookup.enable_stats()
+
+        env = lookup.materialize()
+        self.assertEqual( env['path'], '/opt/bin:/opt/lib' )
+        self.assertEqual( env['c2'], '[counted]' )
+        self.assertEqual( env['when'], env['also_when'] )
+        self.assertEqual( len( env ), 8 )
+        # each macro was looked up once
+        self.assertEqual( lookup.stats()['sources']['entries'], 8 )
+        self.assertEqual( calls, [ 'COUNTED' ] )
+
+        # only what changed is expanded again
+        lookup.enable_stats()
+        lookup.add( 'lib', '${root}/lib64' )
+        env = lookup.materialize( [ 'path', 'bin' ] )
+        self.assertEqual( env, { 'path' : '/opt/bin:/opt/lib64', 'bin' : '/opt/bin' } )
+        # path, lib and root (plain values are not cached)
+        self.assertEqual( lookup.stats()['sources']['entries'], 3 )
+        self.assertEqual( lookup.stats()['sources']['cached'], 1 )
+
+        # errors
+        lookup.add( 'broken', '${nope}' )
+        with self.assertRaises( envmacros.MacroError ):
+            lookup.materialize()
+        errors = dict()
+        env = lookup.materialize( errors = errors )
+        self.assertEqual( errors, { 'broken' : 'Undefined: nope' } )
+        self.assertFalse( 'broken' in env )
+        self.assertEqual( env['path'], '/opt/bin:/opt/lib64' )
+
+    def test_570_eval_vectorized( self ):
+        import envmacros.expressions as em
+        e = create_eval()
+        text = '((0x0100 & (${one}<<(2*${four}))) != 0)'
+        columns = { 'one' : [ 1, 1, 0, 1 ], 'four' : [ 4, 3, 4, 0 ] }
+        expected = []
+        for one, four in zip( columns['one'], columns['four'] ):
+            r = create_eval()
+            r.resolver.lookup.add( 'one', one )
+            r.resolver.lookup.add( 'four', four )
+            expected.append( r.eval( text ).result )
+        self.assertEqual( expected, [ True, False, False, False ] )
+
+        saved = em._numpy_module
+        try:
+            for numpy in (saved, False):
+                # with numpy (if installed) and without
+                em._numpy_module = numpy
+                x = e.eval_vectorized( text, columns )
+                self.assertEqual( x.err_msg, None )
+                self.assertEqual( [ bool(v) for v in x.result ], expected )
+                # math functions, and/or/not, chained compares, macros that use columns
+                x = e.eval_vectorized( 'floor(sqrt(${four})) + (${one} and 10 or 20) + (0 < ${four} < 4) + ${good_two}',
+                                       columns )
+                self.assertEqual( [ int(v) for v in x.result ], [ 14, 14, 23, 12 ] )
+                # not using a column
+                x = e.eval_vectorized( '${seven} * 2', columns )
+                self.assertEqual( [ int(v) for v in x.result ], [ 14 ] * 4 )
+                x = e.eval_vectorized( 'evil(${four})', columns )
+                self.assertEqual( x.err_msg, 'Illegal: evil(' )
+                x = e.eval_vectorized( '${undefined_thing} + ${four}', columns )
+                self.assertEqual( x.err_msg, 'Undefined: undefined_thing' )
+                x = e.eval_vectorized( '${four} / 0', columns )
+                self.assertEqual( x.result, None )
+                self.assertTrue( x.err_msg.startswith( 'Syntax Error: div' ) )
+
+                # other backends evaluate each row, with their limits
+                a = envmacros.ExpressionEvaluator( e.resolver, backend = 'ast' )
+                x = a.eval_vectorized( text, columns )
+                self.assertEqual( x.result, expected )
+                x = a.eval_vectorized( '${one} << ${four}', { 'one' : [ 1 ], 'four' : [ 100000 ] } )
+                self.assertTrue( x.err_msg.startswith( 'Too large' ) )
+                x = a.eval_vectorized( 'factorial(${n})', { 'n' : [ 200000 ] } )
+                self.assertTrue( x.err_msg.startswith( 'Too large' ) )
+
+            em._numpy_module = saved
+            np = em._numpy()
+            if np != None:
+                # numpy columns, evaluated one row at a time
+                a = envmacros.ExpressionEvaluator( e.resolver, backend = 'ast' )
+                x = a.eval_vectorized( text, dict( (n, np.asarray( v )) for n, v in columns.items() ) )
+                self.assertEqual( x.err_msg, None )
+                self.assertEqual( x.result, expected )
+                x = a.eval_vectorized( '${f} * 2', { 'f' : np.asarray( [ 1.5, -0.25 ] ) } )
+                self.assertEqual( x.result, [ 3.0, -0.5 ] )
+
+                # fixed size integers, that would wrap around
+                x = e.eval_vectorized( '-${n}', { 'n' : np.asarray( [ 3, -2**63 ] ) } )
+                self.assertTrue( x.err_msg.startswith( 'Too large' ) )
+                x = e.eval_vectorized( '-${n}', { 'n' : np.asarray( [ 3, -2**62 ] ) } )
+                self.assertEqual( [ int(v) for v in x.result ], [ -3, 2**62 ] )
+                x = e.eval_vectorized( '${n} ** 3', { 'n' : [ 3, 2**62 ] } )
+                self.assertTrue( x.err_msg.startswith( 'Too large' ) )
+                x = e.eval_vectorized( '${n} * 2 + ${n} << 1', { 'n' : [ 3, 2**61 ] } )
+                self.assertTrue( x.err_msg.startswith( 'Too large' ) )
+                # just fits
+                x = e.eval_vectorized( '${n} * 2', { 'n' : [ -3, -2**62 ] } )
+                self.assertEqual( [ int(v) for v in x.result ], [ -6, -2**63 ] )
+        finally:
+            em._numpy_module = saved
+
+        with self.assertRaises( envmacros.MacroError ):
+            e.eval_vectorized( text, { 'one' : [ 1, 2 ], 'four' : [ 1 ] } )
+
+    def test_580_varfile_reload( self ):
+        import tempfile, shutil, threading
+        d = tempfile.mkdtemp()
+        try:
+            a = os.path.join( d, 'a.txt' )
+            b = os.path.join( d, 'b.txt' )
+            def write( fn, text ):
+                with open( fn, 'w' ) as f:
+                    f.write( text )
+                # so the change is seen even within the mtime resolution
+                st = os.stat( fn )
+                os.utime( fn, ns = (st.st_atime_ns, st.st_mtime_ns + 1000000) )
+            write( a, "one = 1\ntwo = (${one}+${one})\n" )
+            write( b, "name = b\n" )
+
+            lookup = envmacros.MacroLookup( allow_env = False, cache = True )
+            resolver = envmacros.MacroResolver( lookup )
+            reloader = envmacros.VarfileReloader( lookup, [ a, b ] )
+            seen = []
+            reloader.subscribe( lambda *changes: seen.append( changes ) )
+            self.assertEqual( reloader.reload(), ( { 'one', 'two', 'name' }, set(), set() ) )
+            self.assertEqual( resolver.resolve( '${two}' ).result, '(1+1)' )
+            self.assertEqual( lookup.where( 'two' ), a + ':2' )
+
+            # nothing changed
+            self.assertEqual( reloader.reload(), ( set(), set(), set() ) )
+            self.assertEqual( len( seen ), 1 )
+
+            # only what changed is applied
+            write( a, "one = 5\n\ntwo = (${one}+${one})\nthree = 3\n" )
+            self.assertEqual( reloader.reload(), ( { 'three' }, { 'one' }, set() ) )
+            self.assertEqual( seen[-1], ( { 'three' }, { 'one' }, set() ) )
+            self.assertEqual( resolver.resolve( '${two}' ).result, '(5+5)' )
+            self.assertEqual( lookup.where( 'two' ), a + ':3' )
+
+            write( a, "one = 5\ntwo = 2\n" )
+            self.assertEqual( reloader.reload(), ( set(), { 'two' }, { 'three' } ) )
+            self.assertFalse( 'three' in lookup.entries )
+
+            # a name can move to another file
+            write( a, "two = 2\n" )
+            write( b, "name = b\none = 5\n" )
+            self.assertEqual( reloader.reload(), ( set(), set(), set() ) )
+            self.assertEqual( lookup.where( 'one' ), b + ':2' )
+
+            # errors change nothing
+            write( a, "two = 2\nname = a\n" )
+            with self.assertRaises( envmacros.MacroDuplicate ):
+                reloader.reload()
+            self.assertEqual( lookup.entries['name'][0], 'b' )
+            write( a, "two = 2\nbroken\n" )
+            with self.assertRaises( envmacros.MacroSyntax ):
+                reloader.reload()
+            write( a, "two = 22\n" )
+            self.assertEqual( reloader.reload(), ( set(), { 'two' }, set() ) )
+
+            # a missing file is empty
+            os.remove( b )
+            self.assertEqual( reloader.reload(), ( set(), set(), { 'name', 'one' } ) )
+
+            # watch() in a thread, polling and with inotify
+            for use_inotify in (False, True):
+                stop = threading.Event()
+                changed = threading.Event()
+                expected = str( use_inotify + 100 )
+                def on_change( added, changed_, removed ):
+                    if lookup.entries.get( 'two', ( None, ) )[0] == expected:
+                        changed.set()
+                reloader.subscribe( on_change )
+                t = threading.Thread( target = reloader.watch,
+                                      kwargs = { 'interval' : 0.05, 'stop' : stop,
+                                                 'use_inotify' : use_inotify } )
+                t.start()
+                try:
+                    # like an editor would, so it is not seen half written
+                    write( a + '.new', "two = %s\n" % expected )
+                    os.replace( a + '.new', a )
+                    self.assertTrue( changed.wait( 5 ) )
+                finally:
+                    stop.set()
+                    t.join()
+                    reloader.unsubscribe( on_change )
+                self.assertEqual( lookup.entries['two'][0], expected )
+        finally:
+            shutil.rmtree( d )
+
+    # microseconds, "import envmacros" takes about 15ms
+    IMPORT_BUDGET_US = 60000
+
+    def test_590_import_time( self ):
+        import subprocess, tempfile, shutil
+        top = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+        env = dict( os.environ )
+        env['PYTHONPATH'] = os.pathsep.join( [ top ] + [ p for p in sys.path if p ] )
+        env.pop( 'PYTHONDONTWRITEBYTECODE', None )
+        # so compiling the source is not measured
+        cache = tempfile.mkdtemp()
+        env['PYTHONPYCACHEPREFIX'] = cache
+        code = ( "import sys, envmacros\n"
+                 "r = envmacros.MacroResolver( envmacros.MacroLookup() )\n"
+                 "assert r.resolve( '${x}y' ).err_msg == 'Undefined: x'\n"
+                 "slow = ( 'asyncio', 'ast', 'inspect', 'concurrent.futures', 'hashlib',\n"
+                 "         'envmacros.expressions', 'envmacros.varfile_reload' )\n"
+                 "print( [ m for m in slow if m in sys.modules ] )\n" )
+        try:
+            for x in range( 2 ):
+                p = subprocess.run( [ sys.executable, '-X', 'importtime', '-c', code ],
+                                    env = env, cwd = top, capture_output = True, text = True )
+        finally:
+            shutil.rmtree( cache )
+        self.assertEqual( p.returncode, 0, p.stderr )
+        # nothing slow was imported just to resolve
+        self.assertEqual( p.stdout.strip(), '[]' )
+        # import time:  self [us] | cumulative | imported package
+        total = None
+        for line in p.stderr.splitlines():
+            parts = line.split( '|' )
+            if (len(parts) == 3) and (parts[2].strip() == 'envmacros'):
+                total = int( parts[1] )
+        my_print( "import envmacros: %d us" % total )
+        self.assertTrue( total < self.IMPORT_BUDGET_US, "import envmacros took %d us" % total )